@@ -3,116 +3,161 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
+import hashlib
+import os
 import six
 
 class Bencode(dict):
     def __init__(self, filename):
         super(Bencode, self).__init__()
         self.filename = filename
+        # The info hash of the file as read, from its exact bytes.
+        self.original_info_hash = None
 
     def read(self):
         self.clear()
         with open(self.filename, 'rb') as torrent:
-            contents = bytelist(torrent.read())
-            self.update(_decode_dict(contents)[0])
+            data = torrent.read()
+        spans = {}
+        self.update(_decode_dict(data, 0, spans)[0])
+        if 'info' in spans:
+            start, end = spans['info']
+            self.original_info_hash = hashlib.sha1(data[start:end]).hexdigest()
 
         return self
 
-    def write(self, filename=None):
-        with open(filename or self.filename, 'wb') as output:
-            output.write(_encode_dict(self))
-
-
-def _decode_item(file):
-    for test, getter in _decoders.items():
-        if test(file[0]):
-            return getter(file)
-    raise Exception('Unknown bencoding object starting with "{}"'.format(file[0]))
-
-
-def _encode_item(item):
+    def write(self, filename=None, replace=True):
+        # Written under a temporary name and renamed over the original so a
+        # crash never leaves a truncated .torrent behind. Without replace, an
+        # existing filename is left alone and OSError is raised instead.
+        filename = filename or self.filename
+        temporary = '%s.%d.tmp' % (filename, os.getpid())
+        with open(temporary, 'wb') as output:
+            output.write(encode(self))
+        if replace:
+            os.rename(temporary, filename)
+            return
+        try:
+            # Unlike a rename, a link fails if filename exists, atomically.
+            os.link(temporary, filename)
+        finally:
+            os.remove(temporary)
+
+    def info_hash(self):
+        return info_hash(self)
+
+
+def decode(data):
+    item, end = _decode_item(data, 0)
+    return item
+
+
+def encode(item):
+    chunks = []
+    _encode_item(item, chunks)
+    return b''.join(chunks)
+
+
+def info_hash(torrent):
+    # Re-encoding reproduces the original bytes for any canonically encoded
+    # torrent (sorted keys, no leading zeros), which every client writes.
+    return hashlib.sha1(encode(torrent['info'])).hexdigest()
+
+
+# The decoders walk one immutable bytes object by index instead of slicing off
+# what they consumed, so decoding is linear in the size of the torrent.
+def _decode_item(data, i):
+    first = data[i:i + 1]
+    if first == b'i':
+        return _decode_int(data, i)
+    if first == b'l':
+        return _decode_list(data, i)
+    if first == b'd':
+        return _decode_dict(data, i)
+    if first.isdigit():
+        return _decode_string(data, i)
+    raise Exception('Unknown bencoding object starting with "{}"'.format(first))
+
+
+def _encode_item(item, chunks):
+    encoder = encoders.get(type(item))
+    if encoder is not None:
+        return encoder(item, chunks)
     for t, encoder in encoders.items():
         if isinstance(item, t):
-            return encoder(item)
+            return encoder(item, chunks)
+    raise Exception('Cannot bencode object of type {}'.format(type(item)))
 
 
-def _decode_int(file):
-    end = file.index(six.byte2int(b'e'))
-    return int(bytelist_to_text(file[1: end])), file[end + 1:]
+def _decode_int(data, i):
+    end = data.index(b'e', i)
+    return int(data[i + 1: end]), end + 1
 
 
-def _encode_int(i):
-    return 'i{}e'.format(i).encode('utf-8')
+def _encode_int(i, chunks):
+    chunks.append('i{}e'.format(i).encode('utf-8'))
 
 
-def _decode_string(file):
-    colon = file.index(six.byte2int(b':'))
-    length = int(bytelist_to_text(file[: colon]))
-    return bytelist_to_text(file[colon + 1: colon + 1 + length]), file[colon + 1 + length:]
+def _decode_string(data, i):
+    colon = data.index(b':', i)
+    start = colon + 1
+    end = start + int(data[i: colon])
+    return data[start: end], end
 
 
-def _encode_text(text):
-    return '{}:{}'.format(len(text), text).encode('utf-8')
+def _encode_text(text, chunks):
+    _encode_bytes(text.encode('utf-8'), chunks)
 
 
-def _encode_bytes(btext):
-    return '{}:'.format(len(btext)).encode('utf-8') + btext
+def _encode_bytes(btext, chunks):
+    chunks.append('{}:'.format(len(btext)).encode('utf-8'))
+    chunks.append(btext)
 
 
-def _decode_list(file):
-    file = file[1:]
+def _decode_list(data, i):
+    i += 1
     lst = []
-    while file[0] != six.byte2int(b'e'):
-        item, file = _decode_item(file)
+    while data[i:i + 1] != b'e':
+        item, i = _decode_item(data, i)
         lst.append(item)
-    return lst, file[1:]
+    return lst, i + 1
 
 
-def _encode_list(lst):
-    data = b'l'
+def _encode_list(lst, chunks):
+    chunks.append(b'l')
     for item in lst:
-        data += _encode_item(item)
-    return data + b'e'
+        _encode_item(item, chunks)
+    chunks.append(b'e')
 
 
-def _decode_dict(file):
-    file = file[1:]
+def _decode_dict(data, i, spans=None):
+    # spans, if given, collects where each value starts and ends in data.
+    i += 1
     dct = {}
-    while file[0] != six.byte2int(b'e'):
-        key, file = _decode_string(file)
-        item, file = _decode_item(file)
-        dct[key.decode('utf-8')] = item
-    return dct, file[1:]
+    while data[i:i + 1] != b'e':
+        key, i = _decode_string(data, i)
+        key = key.decode('utf-8')
+        start = i
+        dct[key], i = _decode_item(data, i)
+        if spans is not None:
+            spans[key] = (start, i)
+    return dct, i + 1
 
 
-def _encode_dict(dct):
-    data = b'd'
-    for key, value in sorted(dct.items()):
-        data += _encode_item(key) + _encode_item(value)
-    return data + b'e'
+def _encode_dict(dct, chunks):
+    chunks.append(b'd')
+    # Keys are sorted as raw bytes, as the specification requires.
+    for key, value in sorted(dct.items(), key=lambda kv: kv[0].encode('utf-8')):
+        _encode_item(key, chunks)
+        _encode_item(value, chunks)
+    chunks.append(b'e')
 
 
-_decoders = {
-    lambda x: x == ord('i'): _decode_int,
-    lambda x: ord('0') <= x <= ord('9'): _decode_string,
-    lambda x: x == ord('l'): _decode_list,
-    lambda x: x == ord('d'): _decode_dict,
-}
 encoders = {
     six.text_type: _encode_text,
     six.binary_type: _encode_bytes,
-    int: _encode_int,
     list: _encode_list,
     dict: _encode_dict,
 }
-
-def bytelist(stream):
-    out = list(stream)
-    if not out:
-        return out
-    if isinstance(out[0], int):
-        return out
-    return [ord(c) for c in out]
-
-def bytelist_to_text(bytelist):
-    return b''.join(map(six.int2byte, bytelist))
+for _integer_type in six.integer_types:
+    encoders[_integer_type] = _encode_int
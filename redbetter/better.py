@@ -8,16 +8,23 @@ import multiprocessing
 import os
 import sys
 
+from redbetter.errors import exit_status
 from redbetter.transcode import Job
 from redbetter.transcode import Defaults
-from redbetter.compat import mutagen
+from redbetter.transcode import torrent_commands
+from redbetter.transcode import transcode_commands
+from redbetter.toolchain import Toolchain
+from redbetter.progress import Progress
+from redbetter.utils import normalize_directory_path
+from redbetter import server
+from redbetter.compat import print_bytes as printb
 
 # noinspection PyBroadException
 
 
 
 # The version number
-__version__ = '0.7'
+__version__ = '0.8'
 __description__ = ''' redbetter (version {})
 Transcode albums and create torrents in one command. Default behavior can be
 changed by editing the code with a text editor and changing variables, or by
@@ -39,7 +46,7 @@ def parse_args():
     transcode_group = parser.add_mutually_exclusive_group()
     torrent_group = parser.add_mutually_exclusive_group()
 
-    parser.add_argument('album', help='The album to process', nargs='+')
+    parser.add_argument('album', help='The album to process', nargs='*')
     parser.add_argument(
             '-v',
             '--version',
@@ -132,8 +139,164 @@ def parse_args():
             default=Defaults.transcode_output,
             help='The directory to store any transcoded albums in '
             '(default: %(default)s)')
+    parser.add_argument(
+            '-q',
+            '--queue',
+            action='store',
+            default=Defaults.queue_dir,
+            help='A work queue directory on a filesystem shared with other '
+            'hosts. Tracks are published there and encoded by '
+            'redbetter-worker processes instead of on this host; copying, '
+            'album art and torrents are still handled here (empty by '
+            'default)')
+    parser.add_argument(
+            '-S',
+            '--scratch',
+            action='store',
+            default=Defaults.scratch_dir,
+            help='A local scratch directory (e.g. on tmpfs) to transcode into. '
+            'Each finished album is moved to the transcode output with one '
+            'sequential copy and an atomic rename (empty by default)')
+    parser.add_argument(
+            '--scratch-limit',
+            action='store',
+            type=int, default=Defaults.scratch_limit,
+            help='The most MiB of albums to keep in the scratch directory at '
+            'once; transcoding waits for albums to be published when it is '
+            'full. 0 for no limit (default: %(default)s)')
+    parser.add_argument(
+            '--torrent-threads',
+            action='store',
+            type=int, default=Defaults.torrent_threads,
+            help='The number of .torrent files to create at once while '
+            'transcoding continues. Any number below 1 creates them one at a '
+            'time between transcodes (default: %(default)s)')
+    parser.add_argument(
+            '--progress-fd',
+            action='store',
+            type=int, default=None,
+            help='A file descriptor to write progress events to, one JSON '
+            'object per line (e.g. 3, with 3>progress.jsonl)')
+    parser.add_argument(
+            '--spectral-check',
+            action='store',
+            choices=['flag', 'skip'],
+            default=Defaults.spectral_check or None,
+            help='Analyse the spectrum of every track (needs NumPy) and warn '
+            'about (flag) or skip (skip) albums that look transcoded from a '
+            'lossy source')
+    parser.add_argument(
+            '--spectral-seconds',
+            action='store',
+            type=int, default=Defaults.spectral_seconds,
+            help='How many seconds from the middle of each track to analyse; '
+            '0 for all of it (default: %(default)s)')
+    parser.add_argument(
+            '--readers-per-device',
+            action='store',
+            type=int, default=Defaults.readers_per_device,
+            help='The most threads reading source files from each disk or '
+            'network mount at once, apart from the encoders. Any number '
+            'below 1 means no limit (default: %(default)s)')
+    parser.add_argument(
+            '--prefetch-limit',
+            action='store',
+            type=int, default=Defaults.prefetch_limit,
+            help='The most MiB of upcoming tracks to read into memory ahead '
+            'of the encoders; 0 to disable read-ahead (default: %(default)s)')
+    parser.add_argument(
+            '--timeout-factor',
+            action='store',
+            type=float, default=Defaults.timeout_factor,
+            help='Seconds each encoder may run per second of audio, on top '
+            'of --timeout-minimum, before it is killed. 0 means no limit '
+            '(default: %(default)s)')
+    parser.add_argument(
+            '--timeout-minimum',
+            action='store',
+            type=float, default=Defaults.timeout_minimum,
+            help='Seconds every encoder may run, however short its track '
+            '(default: %(default)s)')
+    parser.add_argument(
+            '--torrent-timeout',
+            action='store',
+            type=float, default=Defaults.torrent_timeout,
+            help='Seconds creating each .torrent file may take; 0 for no '
+            'limit (default: %(default)s)')
+    parser.add_argument(
+            '--retries',
+            action='store',
+            type=int, default=Defaults.retries,
+            help='How many more times to run an encoder or torrent client '
+            'that failed or timed out (default: %(default)s)')
+    parser.add_argument(
+            '--retry-backoff',
+            action='store',
+            type=float, default=Defaults.retry_backoff,
+            help='Seconds to wait before the first retry, doubling with '
+            'every further one (default: %(default)s)')
+    parser.add_argument(
+            '--trace',
+            action='store',
+            default=Defaults.trace,
+            metavar='FILE',
+            help='Write a timeline of every probe, copy, encode and torrent '
+            'to FILE in Chrome trace-event format, for chrome://tracing or '
+            'ui.perfetto.dev. With --server, of every job until it exits')
+    parser.add_argument(
+            '--toolchain-cache',
+            action='store',
+            default=Defaults.toolchain_cache,
+            metavar='FILE',
+            help='A file to remember where encoders and torrent clients are, '
+            'and their versions, between runs; an empty string to look '
+            'them up every time (default: %(default)s)')
+    parser.add_argument(
+            '--list-tools',
+            action='store_true',
+            help='Print where every encoder and torrent client was found, '
+            'and its version, and exit')
+    parser.add_argument(
+            '--server',
+            action='store',
+            metavar='SOCKET',
+            help='Run as a job server listening on the Unix socket SOCKET. '
+            'Jobs submitted with --connect share one pool of --cores '
+            'encoder slots, --torrent-threads torrent threads and '
+            '--readers-per-device, whatever the jobs ask for')
+    parser.add_argument(
+            '--connect',
+            action='store',
+            metavar='SOCKET',
+            help='Submit the albums as a job to the server listening on '
+            'SOCKET instead of processing them in this process')
+    parser.add_argument(
+            '--detach',
+            action='store_true',
+            help='With --connect, return once the job is accepted instead of '
+            'waiting for it to finish')
+    parser.add_argument(
+            '--priority',
+            action='store',
+            type=int, default=0,
+            help='With --connect, jobs with a lower priority get encoder '
+            'slots first (default: %(default)s)')
+
+    args = parser.parse_args()
+    if not args.album and not args.server and not args.list_tools:
+        parser.error('the following arguments are required: album')
+    return args
 
-    return parser.parse_args()
+
+def list_tools(cache_file):
+    toolchain = Toolchain(
+        os.path.expanduser(cache_file) if cache_file else None)
+    commands = list(transcode_commands.values()) + sorted(torrent_commands)
+    toolchain.probe(['ffprobe'] + commands)
+    for name in sorted(toolchain.paths):
+        printb('%-20s %s' % (name, toolchain.paths[name] or 'not found'))
+        if toolchain.version(name):
+            printb('%-20s %s' % ('', toolchain.version(name)))
 
 
 def main():
@@ -154,7 +317,23 @@ def main():
     explicit_torrent = args.make_torrent
     original_torrent = args.make_torrent == 2
 
-    job = Job(
+    progress = None
+    if args.progress_fd is not None:
+        progress = Progress(stream=os.fdopen(args.progress_fd, 'w'))
+
+    if args.list_tools:
+        list_tools(args.toolchain_cache)
+        return
+
+    if args.server:
+        cores = args.cores if args.cores >= 1 else multiprocessing.cpu_count()
+        server.serve(args.server, cores, args.trace,
+                     torrent_threads=args.torrent_threads,
+                     readers_per_device=args.readers_per_device,
+                     toolchain_cache=args.toolchain_cache)
+        return
+
+    arguments = dict(
         albums = args.album,
 
         announce = args.announce,
@@ -167,9 +346,39 @@ def main():
         source = args.source,
         torrent_output = args.torrent_output,
         transcode_output = args.transcode_output,
+        queue_dir = args.queue,
+        scratch_dir = args.scratch,
+        scratch_limit = args.scratch_limit,
+        torrent_threads = args.torrent_threads,
+        spectral_check = args.spectral_check or '',
+        spectral_seconds = args.spectral_seconds,
+        readers_per_device = args.readers_per_device,
+        prefetch_limit = args.prefetch_limit,
+        timeout_factor = args.timeout_factor,
+        timeout_minimum = args.timeout_minimum,
+        torrent_timeout = args.torrent_timeout,
+        retries = args.retries,
+        retry_backoff = args.retry_backoff,
+        trace = args.trace,
+        toolchain_cache = args.toolchain_cache,
 
         explicit_torrent = explicit_torrent,
         explicit_transcode = explicit_transcode,
         original_torrent = original_torrent,
     )
+
+    if args.connect:
+        # The server doesn't share our working directory.
+        for key in ('torrent_output', 'transcode_output', 'queue_dir',
+                    'scratch_dir', 'trace', 'toolchain_cache'):
+            if arguments[key]:
+                arguments[key] = normalize_directory_path(arguments[key])
+        arguments['albums'] = [normalize_directory_path(album)
+                               for album in arguments['albums']]
+        arguments['snip_prefixes'] = list(arguments['snip_prefixes'])
+        sys.exit(exit_status(server.submit(
+            args.connect, arguments, args.priority, not args.detach,
+            progress.write if progress is not None else None)))
+
+    job = Job(progress=progress, **arguments)
     job.start()
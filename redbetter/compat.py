@@ -3,17 +3,33 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
+import importlib
 import os
 import pipes
 import six
 import sys
 
 
+# Optional dependencies are imported the first time they are needed instead
+# of at startup, which NumPy alone slows down noticeably. Each function
+# returns the module, or None if it isn't installed.
+_optional_modules = {}
+
+def _import_optional(name):
+    if name not in _optional_modules:
+        try:
+            _optional_modules[name] = importlib.import_module(name)
+        except ImportError:
+            _optional_modules[name] = None
+    return _optional_modules[name]
+
 # Mutagen
-try:
-    import mutagen
-except:
-    mutagen = None
+def get_mutagen():
+    return _import_optional('mutagen')
+
+# NumPy
+def get_numpy():
+    return _import_optional('numpy')
 
 
 # quote
@@ -26,6 +42,15 @@ elif six.PY3:
         from pipes import quote
 
 
+# Keyword arguments for subprocess.Popen that start the child in a session of
+# its own. preexec_fn is unsafe when other threads are running, so it is only
+# used where start_new_session doesn't exist.
+if six.PY2:
+    new_session = {'preexec_fn': os.setsid}
+else:
+    new_session = {'start_new_session': True}
+
+
 # Unicode handling is really obnoxious in Python 2.x. These helper functions
 # make it clear which type of string/bytes object you have, and allow handling
 # files and directories with unicode characters.
@@ -0,0 +1,459 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import argparse
+import collections
+import errno
+import hashlib
+import io
+import json
+import os
+import sys
+
+from redbetter.bencode import Bencode
+from redbetter.compat import print_bytes as printb
+from redbetter.compat import to_unicode
+from redbetter.errors import CROSS_SEED_ERROR
+from redbetter.errors import FILE_NOT_FOUND
+from redbetter.errors import exit_status
+from redbetter.retorrent import find_torrents
+from redbetter.utils import map_in_pool
+from redbetter.utils import write_rows
+
+
+# The index is one JSON file mapping each .torrent path to what matching
+# needs: its name, info hash, piece length and the length of every file. It
+# is refreshed incrementally, reading only .torrent files whose mtime or
+# size changed since they were indexed, and the lookup by file size is built
+# from it in memory. Piece hashes are not kept; the few torrents that match a
+# candidate by size are read again to verify it.
+INDEX_VERSION = 1
+DEFAULT_INDEX = os.path.join('~', '.cache', 'redbetter', 'crossseed.json')
+
+# How many pieces of each match are hashed to confirm it.
+SAMPLE_PIECES = 4
+
+# Torrents are looked up by this many of a candidate's largest distinct file
+# sizes, so an extra file the torrent doesn't have (a scan, a log) can't hide
+# the match.
+LOOKUP_SIZES = 3
+
+LINK = 'link'
+SYMLINK = 'symlink'
+RENAME = 'rename'
+MODES = (LINK, SYMLINK, RENAME)
+
+PLAN_FIELDS = ['candidate', 'torrent', 'info_hash', 'action', 'source',
+               'target', 'error']
+
+
+def is_padding(entry):
+    # BEP 47 padding files hold zeros between real files and are never on disk.
+    return b'p' in entry.get('attr', b'')
+
+
+def torrent_files(info):
+    # Returns (path relative to the torrent's name, length, padding) for every
+    # file in the order the pieces cover them; a single-file torrent has one
+    # file with an empty relative path.
+    if 'files' not in info:
+        return [('', info['length'], False)]
+    return [('/'.join(to_unicode(part) for part in entry['path']),
+             entry['length'], is_padding(entry))
+            for entry in info['files']]
+
+
+def index_torrent(path):
+    # Returns (path, entry), or (path, {'error': ...}) if it can't be read.
+    try:
+        stat = os.stat(path)
+        torrent = Bencode(path).read()
+        info = torrent['info']
+        return path, {
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'name': to_unicode(info['name']),
+            'info_hash': torrent.original_info_hash,
+            'piece_length': info['piece length'],
+            'files': [[name, length]
+                      for name, length, padding in torrent_files(info)
+                      if not padding],
+        }
+    except Exception as e:
+        return path, {'error': to_unicode(str(e))}
+
+
+class TorrentIndex(object):
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.torrents = {}
+        self.by_size = None
+
+    def load(self):
+        try:
+            with io.open(self.filename, encoding='utf-8') as index:
+                data = json.load(index)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return self
+        except ValueError:
+            # A corrupt index is rebuilt from scratch.
+            return self
+        if data.get('version') == INDEX_VERSION:
+            self.torrents = data['torrents']
+        return self
+
+    def save(self):
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary = '%s.%d.tmp' % (self.filename, os.getpid())
+        with io.open(temporary, 'w', encoding='utf-8') as index:
+            index.write(to_unicode(json.dumps(
+                {'version': INDEX_VERSION, 'torrents': self.torrents})))
+        os.rename(temporary, self.filename)
+
+    def update(self, paths, processes=None):
+        # Brings the index in line with the .torrent files found under paths
+        # and returns the rows of those that could not be read.
+        found = set(os.path.abspath(path) for path in find_torrents(paths))
+        # Torrents indexed from other directories stay indexed as long as
+        # they exist; only the rescanned ones are known to be complete.
+        roots = [os.path.join(os.path.abspath(path), '')
+                 if os.path.isdir(path) else os.path.abspath(path)
+                 for path in paths]
+        for path in list(self.torrents):
+            if path in found:
+                continue
+            rescanned = any(path.startswith(root) if root.endswith(os.sep)
+                            else path == root for root in roots)
+            if rescanned or not os.path.exists(path):
+                del self.torrents[path]
+
+        stale = []
+        for path in sorted(found):
+            entry = self.torrents.get(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.torrents.pop(path, None)
+                continue
+            if (entry is None or entry.get('mtime') != stat.st_mtime or
+                    entry.get('size') != stat.st_size):
+                stale.append(path)
+
+        failed = []
+        for path, entry in map_in_pool(index_torrent, stale, processes):
+            if 'error' in entry:
+                self.torrents.pop(path, None)
+                failed.append({'path': path, 'error': entry['error']})
+            else:
+                self.torrents[path] = entry
+        self.by_size = None
+        return failed
+
+    def lookup(self, size):
+        if self.by_size is None:
+            self.by_size = collections.defaultdict(set)
+            for path, entry in self.torrents.items():
+                for _, length in entry['files']:
+                    if length:
+                        self.by_size[length].add(path)
+        return self.by_size.get(size, ())
+
+
+def scan_candidate(directory):
+    # Returns {relative path: size} of every file under directory.
+    files = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            files[os.path.relpath(path, directory).replace(os.sep, '/')] = (
+                os.path.getsize(path))
+    return files
+
+
+def assign_files(entry, files):
+    # Pairs every file of the torrent with a distinct candidate file of the
+    # same size, preferring one at the same relative path, then one with the
+    # same name. Returns {torrent path: candidate path}, or None if some
+    # torrent file has no counterpart.
+    by_size = collections.defaultdict(list)
+    for path, size in sorted(files.items()):
+        by_size[size].append(path)
+
+    # Each preference is settled for every file before the next one is
+    # tried, so a file's fallback can't take another file's exact match.
+    preferences = [
+        lambda name, choice: choice == name,
+        lambda name, choice: (choice.rsplit('/', 1)[-1] ==
+                              name.rsplit('/', 1)[-1]),
+        lambda name, choice: True,
+    ]
+    assigned = {}
+    for preference in preferences:
+        for name, length in entry['files']:
+            if name in assigned:
+                continue
+            for choice in by_size.get(length, ()):
+                if preference(name, choice):
+                    by_size[length].remove(choice)
+                    assigned[name] = choice
+                    break
+    if len(assigned) < len(entry['files']):
+        return None
+    return assigned
+
+
+def find_matches(index, directory):
+    # Returns (torrent path, {torrent path: candidate path}) for every indexed
+    # torrent whose files all exist in directory by size.
+    files = scan_candidate(directory)
+    sizes = sorted(set(size for size in files.values() if size), reverse=True)
+    torrents = set()
+    for size in sizes[:LOOKUP_SIZES]:
+        torrents.update(index.lookup(size))
+
+    matches = []
+    for path in sorted(torrents):
+        assigned = assign_files(index.torrents[path], files)
+        if assigned is not None:
+            matches.append((path, assigned))
+    return matches
+
+
+def sample_pieces(count, samples):
+    # Evenly spaced pieces, always including the first and the last.
+    if count <= samples:
+        return list(range(count))
+    if samples < 2:
+        return [0][:samples]
+    return sorted(set((count - 1) * i // (samples - 1) for i in range(samples)))
+
+
+def read_span(path, offset, length):
+    with open(path, 'rb') as source:
+        source.seek(offset)
+        data = source.read(length)
+    if len(data) != length:
+        raise IOError('%s is shorter than expected' % (path))
+    return data
+
+
+def verify_match(torrent_path, directory, assigned, samples=SAMPLE_PIECES):
+    # Hashes the sampled pieces from the candidate's files and compares them
+    # with the torrent's piece hashes.
+    info = Bencode(torrent_path).read()['info']
+    piece_length = info['piece length']
+    pieces = info['pieces']
+
+    layout = []
+    offset = 0
+    for name, length, padding in torrent_files(info):
+        source = None if padding else os.path.join(directory, assigned[name])
+        layout.append((offset, length, source))
+        offset += length
+    total = offset
+
+    count = len(pieces) // 20
+    for piece in sample_pieces(count, samples):
+        start = piece * piece_length
+        end = min(start + piece_length, total)
+        sha1 = hashlib.sha1()
+        for file_offset, length, source in layout:
+            low = max(start, file_offset)
+            high = min(end, file_offset + length)
+            if low >= high:
+                continue
+            if source is None:
+                sha1.update(b'\0' * (high - low))
+            else:
+                sha1.update(read_span(source, low - file_offset, high - low))
+        if sha1.digest() != pieces[piece * 20:piece * 20 + 20]:
+            return False
+    return True
+
+
+def plan_match(entry, directory, assigned, mode, output=None):
+    # Returns (source, target) for every file that has to be linked or moved
+    # for the torrent's layout to exist; the torrent's name becomes a
+    # directory under output (link modes) or next to the candidate (rename).
+    root = output if mode != RENAME else os.path.dirname(
+        os.path.abspath(directory))
+    steps = []
+    for name, _ in entry['files']:
+        source = os.path.join(os.path.abspath(directory), assigned[name])
+        target = os.path.join(root, entry['name'], *name.split('/')) if name \
+            else os.path.join(root, entry['name'])
+        if source != target:
+            steps.append((source, target))
+    return steps
+
+
+def apply_step(mode, source, target):
+    if os.path.lexists(target):
+        raise OSError(errno.EEXIST, 'Target exists', target)
+    if mode == RENAME:
+        # Also removes the directories the move leaves empty.
+        os.renames(source, target)
+        return
+    directory = os.path.dirname(target)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if mode == SYMLINK:
+        os.symlink(source, target)
+    else:
+        os.link(source, target)
+
+
+def match_candidates(index, candidates, mode=LINK, output=None,
+                     samples=SAMPLE_PIECES, apply=False):
+    # Returns one plan row per file to link or move for every verified match,
+    # and one row with an error for every candidate that failed.
+    rows = []
+    for directory in candidates:
+        verified = 0
+        for torrent_path, assigned in find_matches(index, directory):
+            entry = index.torrents[torrent_path]
+            row = {'candidate': directory, 'torrent': torrent_path,
+                   'info_hash': entry['info_hash'], 'action': mode,
+                   'source': '', 'target': '', 'error': ''}
+            try:
+                if not verify_match(torrent_path, directory, assigned,
+                                    samples):
+                    continue
+            except (IOError, OSError) as e:
+                rows.append(dict(row, error=to_unicode(str(e))))
+                continue
+
+            # The candidate can only be renamed into one torrent's layout.
+            if mode == RENAME and verified:
+                rows.append(dict(row, error='Already renamed for another '
+                                 'torrent'))
+                continue
+            verified += 1
+
+            steps = plan_match(entry, directory, assigned, mode, output)
+            if not steps:
+                rows.append(dict(row, action='none'))
+            for source, target in steps:
+                step = dict(row, source=source, target=target)
+                if apply:
+                    try:
+                        apply_step(mode, source, target)
+                    except (IOError, OSError) as e:
+                        step['error'] = to_unicode(str(e))
+                rows.append(step)
+
+        if not verified:
+            rows.append({'candidate': directory, 'torrent': '',
+                         'info_hash': '', 'action': '', 'source': '',
+                         'target': '', 'error': 'No matching torrent'})
+    return rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Find the .torrent files whose data already exists in '
+        'album directories, confirm them by hashing a few pieces, and plan '
+        'the links or renames needed to cross-seed them.')
+    parser.add_argument(
+            'candidates',
+            nargs='*',
+            help='Album directories to match against the index')
+    parser.add_argument(
+            '-t',
+            '--torrents',
+            nargs='*',
+            default=[],
+            help='.torrent files, or directories to search for them, to '
+            'bring the index up to date with before matching')
+    parser.add_argument(
+            '-I',
+            '--index',
+            action='store',
+            default=DEFAULT_INDEX,
+            help='The index file to keep (default: %(default)s)')
+    parser.add_argument(
+            '-m',
+            '--mode',
+            choices=MODES,
+            default=LINK,
+            help='Hardlink or symlink the files into the layout of each '
+            'matching torrent under --output, or rename the candidate into '
+            'it in place (default: %(default)s)')
+    parser.add_argument(
+            '-o',
+            '--output',
+            action='store',
+            help='The directory to create linked layouts in. Required with '
+            'the link modes')
+    parser.add_argument(
+            '-n',
+            '--samples',
+            action='store',
+            type=int, default=SAMPLE_PIECES,
+            help='The number of pieces to hash to confirm each match '
+            '(default: %(default)s)')
+    parser.add_argument(
+            '-p',
+            '--plan',
+            action='store',
+            help='A .csv or .json file to write the plan to')
+    parser.add_argument(
+            '--apply',
+            action='store_true',
+            help='Carry out the plan instead of only reporting it')
+    parser.add_argument(
+            '-c',
+            '--cores',
+            action='store',
+            type=int, default=0,
+            help='The number of processes to index with. Any number below 1 '
+            'means to use the number of CPU cores in the system '
+            '(default: %(default)s)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    exit_code = 0
+
+    if args.mode != RENAME and args.candidates and not args.output:
+        printb('--output is required with --mode %s' % (args.mode))
+        sys.exit(FILE_NOT_FOUND)
+    if args.output and not os.path.isdir(args.output):
+        printb('There is no output directory: %s' % (args.output))
+        sys.exit(FILE_NOT_FOUND)
+
+    index = TorrentIndex(os.path.expanduser(args.index)).load()
+    if args.torrents:
+        failed = index.update(args.torrents,
+                              args.cores if args.cores >= 1 else None)
+        for row in failed:
+            printb('Could not index %s: %s' % (row['path'], row['error']))
+        index.save()
+        printb('Indexed %d torrents' % (len(index.torrents)))
+
+    rows = match_candidates(index, args.candidates, args.mode,
+                            args.output and os.path.abspath(args.output),
+                            args.samples, args.apply)
+    for row in rows:
+        if row['error']:
+            printb('%s: %s' % (row['candidate'], row['error']))
+            exit_code |= CROSS_SEED_ERROR
+        elif row['source']:
+            printb('%s %s -> %s' % (row['action'], row['source'],
+                                    row['target']))
+    matched = set(row['candidate'] for row in rows if row['torrent'] and
+                  not row['error'])
+    printb('Matched %d of %d candidates' % (len(matched),
+                                            len(args.candidates)))
+
+    if args.plan:
+        write_rows(rows, PLAN_FIELDS, args.plan)
+
+    sys.exit(exit_status(exit_code))
@@ -16,3 +16,17 @@ NO_TRANSCODER = 1 << 7
 TORRENT_ERROR = 1 << 8
 TRANSCODE_ERROR = 1 << 9
 SOURCE_EMBED_ERROR = 1 << 10
+PUBLISH_ERROR = 1 << 11
+TORRENT_EDIT_ERROR = 1 << 12
+LOSSY_MASTER = 1 << 13
+CROSS_SEED_ERROR = 1 << 14
+TIMEOUT_ERROR = 1 << 15
+
+
+def exit_status(errors):
+    # A process exits with only the low 8 bits of its status, which would turn
+    # errors from TORRENT_ERROR up into success. Those exit with 255 instead;
+    # the whole bitmask is logged and returned by Job.run().
+    if errors > 0xff:
+        return 0xff
+    return errors
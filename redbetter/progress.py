@@ -0,0 +1,130 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import collections
+import json
+import threading
+import time
+
+
+# The ETA is based on the throughput of the last this many finished tasks, so
+# it follows changes in speed (e.g. a switch to a slower format) quickly.
+THROUGHPUT_WINDOW = 32
+
+# Events emitted while transcoding:
+#   batch_queued   the job starts, with the number of 'albums' and 'formats'
+#                  and the 'bytes' of lossless tracks they add up to
+#   task_queued    a track is waiting for an encoder slot
+#   task_started   an encoder was started for a track
+#   task_finished  a track's encoder exited with 0
+#   task_retried   a track's encoder failed or timed out and is run again
+#   task_failed    a track's encoder exited with anything else on its last
+#                  attempt, the track was skipped after failing before, or
+#                  transcoding it raised an 'error'
+#   format_finished  all of an album's tracks for one format are done
+#   album_finished   everything for an album has been started or done; its
+#                  'bytes' are what batch_queued expected of it
+# Every event carries 'event' and 'time'; task events also carry 'album',
+# 'format', 'file', 'bytes' and 'seconds' (of audio), and finished or failed
+# ones the rolling 'bytes_per_second' and 'eta' (in seconds, None when
+# unknown yet) along with totals of what is processed and remaining. The
+# ETA covers the tasks queued so far and the 'bytes_unqueued' batch_queued
+# expects of the albums and formats still to come; what an album doesn't
+# queue after all (skipped formats, linked tracks) leaves the estimate once
+# the album is finished.
+BATCH_QUEUED = 'batch_queued'
+TASK_QUEUED = 'task_queued'
+TASK_STARTED = 'task_started'
+TASK_FINISHED = 'task_finished'
+TASK_RETRIED = 'task_retried'
+TASK_FAILED = 'task_failed'
+FORMAT_FINISHED = 'format_finished'
+ALBUM_FINISHED = 'album_finished'
+
+
+def task_key(fields):
+    return fields['album'], fields['format'], fields['file']
+
+
+class Progress(object):
+    # stream is a file object that receives one JSON object per line and
+    # callback a function called with each event as a dict. With neither,
+    # emitting an event does nothing.
+    def __init__(self, stream=None, callback=None, window=THROUGHPUT_WINDOW):
+        self.stream = stream
+        self.callback = callback
+        self.enabled = stream is not None or callback is not None
+        self.lock = threading.Lock()
+        self.finished = collections.deque(maxlen=window)
+        self.start_time = time.time()
+        self.bytes_done = 0
+        self.bytes_remaining = 0
+        self.seconds_done = 0.0
+        self.seconds_remaining = 0.0
+        self.bytes_unqueued = 0
+        self.album_queued = collections.defaultdict(int)
+        # The bytes and seconds of every task queued but not finished or
+        # failed yet, so that a task is accounted for once, whatever it emits.
+        self.pending = {}
+
+    def emit(self, event, **fields):
+        if not self.enabled:
+            return
+        fields['event'] = event
+        fields['time'] = time.time()
+        with self.lock:
+            if event == BATCH_QUEUED:
+                self.bytes_unqueued += fields['bytes']
+            elif event == TASK_QUEUED:
+                self.pending[task_key(fields)] = (fields['bytes'],
+                                                  fields['seconds'])
+                self.bytes_remaining += fields['bytes']
+                self.seconds_remaining += fields['seconds']
+                self.bytes_unqueued -= fields['bytes']
+                self.album_queued[fields['album']] += fields['bytes']
+            elif event == ALBUM_FINISHED:
+                self.bytes_unqueued -= (fields.get('bytes', 0) -
+                                        self.album_queued.pop(fields['album'], 0))
+            elif event in (TASK_FINISHED, TASK_FAILED):
+                self._account(fields)
+            self.write(fields)
+
+    def _account(self, fields):
+        if task_key(fields) in self.pending:
+            size, seconds = self.pending.pop(task_key(fields))
+            self.bytes_done += size
+            self.bytes_remaining -= size
+            self.seconds_done += seconds
+            self.seconds_remaining -= seconds
+            self.finished.append((fields['time'], size))
+
+        # The window starts when its oldest task finished, or when the batch
+        # started while the window is still filling up.
+        if len(self.finished) == self.finished.maxlen:
+            since, first = self.finished[0]
+            window_bytes = sum(b for _, b in self.finished) - first
+        else:
+            since = self.start_time
+            window_bytes = sum(b for _, b in self.finished)
+
+        elapsed = fields['time'] - since
+        rate = window_bytes / elapsed if elapsed > 0 else 0
+        unqueued = max(self.bytes_unqueued, 0)
+        fields['bytes_per_second'] = rate
+        fields['eta'] = ((self.bytes_remaining + unqueued) / rate
+                         if rate > 0 else None)
+        fields['bytes_done'] = self.bytes_done
+        fields['bytes_remaining'] = self.bytes_remaining
+        fields['bytes_unqueued'] = unqueued
+        fields['seconds_done'] = self.seconds_done
+        fields['seconds_remaining'] = self.seconds_remaining
+
+    def write(self, fields):
+        # Passes an event on as is, e.g. one relayed from a job server.
+        if self.stream is not None:
+            self.stream.write(json.dumps(fields) + '\n')
+            self.stream.flush()
+        if self.callback is not None:
+            self.callback(fields)
@@ -0,0 +1,141 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import collections
+import threading
+
+
+# What Job.run() returns: the outcome of every album, of every format of each
+# album and of every file of each format. errors is always a bitmask of
+# redbetter.errors; an error of a format is an error of its album too, and
+# every error is one of the whole result.
+
+
+class FileResult(object):
+    def __init__(self, source, output):
+        self.source = source
+        self.output = output
+        # The encoder's exit code, None if it never ran.
+        self.returncode = None
+        # Whether the output exists and isn't empty, None if not checked yet.
+        self.valid = None
+        # How many times the encoder ran, whether its last run timed out, and
+        # whether it never ran because the track failed for another format.
+        self.attempts = 0
+        self.timed_out = False
+        self.quarantined = False
+        # Whether the source already had the format's bit depth and sample
+        # rate and was linked or copied as it is instead of being transcoded.
+        self.unchanged = False
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and self.valid is True
+
+    def to_dict(self):
+        return {'source': self.source, 'output': self.output,
+                'returncode': self.returncode, 'valid': self.valid,
+                'attempts': self.attempts, 'timed_out': self.timed_out,
+                'quarantined': self.quarantined,
+                'unchanged': self.unchanged, 'ok': self.ok}
+
+
+class FormatResult(object):
+    def __init__(self, album, transcode_format):
+        self.album = album
+        self.format = transcode_format
+        # The transcoded directory and its .torrent file, once known.
+        self.output = None
+        self.torrent = None
+        # Why the format was not transcoded, if it wasn't.
+        self.skipped = None
+        self.errors = 0
+        self.files = collections.OrderedDict()
+
+    def file(self, source, output):
+        if source not in self.files:
+            self.files[source] = FileResult(source, output)
+        return self.files[source]
+
+    def add_error(self, code):
+        self.errors |= code
+        self.album.add_error(code)
+
+    @property
+    def ok(self):
+        return self.errors == 0
+
+    def to_dict(self):
+        return {'format': self.format, 'output': self.output,
+                'torrent': self.torrent, 'skipped': self.skipped,
+                'errors': self.errors, 'ok': self.ok,
+                'files': [f.to_dict() for f in self.files.values()]}
+
+
+class AlbumResult(object):
+    def __init__(self, result, path):
+        self.result = result
+        self.path = path
+        # The .torrent file of the album itself, with -mm.
+        self.torrent = None
+        # Why the album was not transcoded, if it wasn't.
+        self.skipped = None
+        # Whether the spectral check found the album transcoded from a lossy
+        # source, None if it wasn't checked, and the cutoff (Hz) it found in
+        # each analysed track, None for none.
+        self.flagged = None
+        self.cutoffs = collections.OrderedDict()
+        self.errors = 0
+        self.formats = collections.OrderedDict()
+
+    def format(self, transcode_format):
+        with self.result.lock:
+            if transcode_format not in self.formats:
+                self.formats[transcode_format] = FormatResult(
+                    self, transcode_format)
+            return self.formats[transcode_format]
+
+    def add_error(self, code):
+        self.errors |= code
+        self.result.add_error(code)
+
+    @property
+    def ok(self):
+        return self.errors == 0
+
+    def to_dict(self):
+        return {'path': self.path, 'torrent': self.torrent,
+                'skipped': self.skipped, 'flagged': self.flagged,
+                'cutoffs': dict(self.cutoffs), 'errors': self.errors,
+                'ok': self.ok,
+                'formats': [f.to_dict() for f in self.formats.values()]}
+
+
+class Result(object):
+    def __init__(self):
+        self.errors = 0
+        self.albums = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+    def album(self, path):
+        with self.lock:
+            if path not in self.albums:
+                self.albums[path] = AlbumResult(self, path)
+            return self.albums[path]
+
+    def add_error(self, code):
+        self.errors |= code
+
+    @property
+    def exit_code(self):
+        return self.errors
+
+    @property
+    def ok(self):
+        return self.errors == 0
+
+    def to_dict(self):
+        return {'errors': self.errors, 'ok': self.ok,
+                'albums': [a.to_dict() for a in self.albums.values()]}
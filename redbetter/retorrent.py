@@ -0,0 +1,210 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import argparse
+import errno
+import io
+import os
+import sys
+
+from redbetter.bencode import Bencode
+from redbetter.compat import print_bytes as printb
+from redbetter.compat import to_unicode
+from redbetter.errors import FILE_NOT_FOUND
+from redbetter.errors import TORRENT_EDIT_ERROR
+from redbetter.errors import exit_status
+from redbetter.utils import adjust_prefixes
+from redbetter.utils import map_in_pool
+from redbetter.utils import write_rows
+
+
+def find_torrents(paths):
+    torrents = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for file in sorted(files):
+                    if file.endswith('.torrent'):
+                        torrents.append(os.path.join(root, file))
+        else:
+            torrents.append(path)
+    return torrents
+
+
+MAPPING_FIELDS = ['path', 'new_path', 'old_info_hash', 'new_info_hash', 'error']
+
+
+def mapping_row(path):
+    return {'path': path, 'new_path': '', 'old_info_hash': '',
+            'new_info_hash': '', 'error': ''}
+
+
+def new_torrent_path(path, output, edits):
+    filename = os.path.basename(path)
+    if edits.get('prefix') or edits.get('snip_prefixes'):
+        filename = adjust_prefixes(filename,
+                                   edits.get('prefix'),
+                                   edits.get('snip_prefixes'))
+    return os.path.join(output or os.path.dirname(path), filename)
+
+
+def edit_torrent(task):
+    # Applies edits to one .torrent file, written to new_path, and returns a
+    # row of the old to new mapping, with any error in it.
+    path, new_path, output, edits = task
+    row = mapping_row(path)
+    try:
+        torrent = Bencode(path).read()
+        row['old_info_hash'] = torrent.original_info_hash
+        info = torrent['info']
+
+        if edits.get('announce') is not None:
+            torrent['announce'] = edits['announce']
+            torrent.pop('announce-list', None)
+
+        if edits.get('source') is not None:
+            if edits['source']:
+                info['source'] = edits['source']
+            else:
+                info.pop('source', None)
+
+        if edits.get('prefix') or edits.get('snip_prefixes'):
+            info['name'] = adjust_prefixes(to_unicode(info['name']),
+                                           edits.get('prefix'),
+                                           edits.get('snip_prefixes'))
+
+        # Only the torrent itself is ever replaced, never another one.
+        if new_path != path and os.path.lexists(new_path):
+            raise OSError(errno.EEXIST, 'Target exists', new_path)
+        torrent.write(new_path, replace=new_path == path)
+        if new_path != path and not output:
+            os.remove(path)
+
+        row['new_path'] = new_path
+        row['new_info_hash'] = torrent.info_hash()
+    except Exception as e:
+        row['error'] = to_unicode(str(e))
+    return row
+
+
+def edit_torrents(torrents, edits, output=None, processes=None):
+    # Two torrents can end up with the same new path, e.g. A.torrent and
+    # FLA.torrent with FL snipped, or same-named torrents from different
+    # directories with an output directory: only the first is edited. Edited
+    # in place, every torrent keeps its own path for itself.
+    rows = [None] * len(torrents)
+    claimed = set() if output else set(torrents)
+    tasks = []
+    positions = []
+    for position, path in enumerate(torrents):
+        new_path = new_torrent_path(path, output, edits)
+        if new_path != path and new_path in claimed:
+            rows[position] = dict(
+                mapping_row(path),
+                error='Another torrent is written to %s' % (new_path))
+            continue
+        claimed.add(new_path)
+        tasks.append((path, new_path, output, edits))
+        positions.append(position)
+
+    for position, row in zip(positions, map_in_pool(edit_torrent, tasks,
+                                                   processes)):
+        rows[position] = row
+    return rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Edit the announce URL, source and name prefix of many '
+        '.torrent files at once and report the old and new info hashes.')
+    parser.add_argument(
+            'torrents',
+            nargs='*',
+            help='.torrent files, or directories to search for them')
+    parser.add_argument(
+            '-i',
+            '--input-list',
+            action='store',
+            help='A file listing one .torrent path per line')
+    parser.add_argument(
+            '-a',
+            '--announce',
+            action='store',
+            help='The announce URL to set. Replaces any announce list')
+    parser.add_argument(
+            '-s',
+            '--source',
+            action='store',
+            help='The source to set; an empty string removes it')
+    parser.add_argument(
+            '-p',
+            '--prefix',
+            action='store',
+            default='',
+            help='A prefix to add to the torrent name and .torrent filename')
+    parser.add_argument(
+            '-x',
+            '--snip-prefixes',
+            dest='snip_prefixes',
+            nargs='*',
+            default=[],
+            help='Prefixes to remove from the torrent name and .torrent '
+            'filename, performed before any prefix is added')
+    parser.add_argument(
+            '-o',
+            '--output',
+            action='store',
+            help='A directory to write edited .torrent files to instead of '
+            'editing them in place')
+    parser.add_argument(
+            '-m',
+            '--mapping',
+            action='store',
+            help='A .csv or .json file to write the old to new info hash '
+            'mapping to')
+    parser.add_argument(
+            '-c',
+            '--cores',
+            action='store',
+            type=int, default=0,
+            help='The number of processes to edit with. Any number below 1 '
+            'means to use the number of CPU cores in the system '
+            '(default: %(default)s)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    exit_code = 0
+
+    paths = list(args.torrents)
+    if args.input_list:
+        with io.open(args.input_list, encoding='utf-8') as listing:
+            paths.extend(line.rstrip('\n') for line in listing if line.strip())
+
+    if args.output and not os.path.isdir(args.output):
+        printb('There is no output directory: %s' % (args.output))
+        sys.exit(FILE_NOT_FOUND)
+
+    torrents = find_torrents(paths)
+    edits = {
+        'announce': args.announce,
+        'source': args.source,
+        'prefix': args.prefix,
+        'snip_prefixes': args.snip_prefixes,
+    }
+    rows = edit_torrents(torrents, edits, args.output,
+                         args.cores if args.cores >= 1 else None)
+
+    failed = [row for row in rows if row['error']]
+    for row in failed:
+        printb('Could not edit %s: %s' % (row['path'], row['error']))
+        exit_code |= TORRENT_EDIT_ERROR
+    printb('Edited %d of %d torrents' % (len(rows) - len(failed), len(rows)))
+
+    if args.mapping:
+        write_rows(rows, MAPPING_FIELDS, args.mapping)
+
+    sys.exit(exit_status(exit_code))
@@ -0,0 +1,146 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import contextlib
+import heapq
+import itertools
+import os
+import threading
+
+
+# The size of each read when pulling a file into the page cache.
+READ_AHEAD_CHUNK = 1024 * 1024
+
+
+class SlotPool(object):
+    # A fixed number of numbered encoder slots shared by every job in the
+    # process. Waiters are served lowest priority value first, then in the
+    # order they asked, so an urgent job overtakes a long batch at its next
+    # track without preempting anything already encoding.
+    def __init__(self, size):
+        self.size = size
+        self.free = list(range(size))
+        self.waiting = []
+        self.tickets = itertools.count()
+        self.condition = threading.Condition()
+
+    def acquire(self, priority=0):
+        with self.condition:
+            ticket = (priority, next(self.tickets))
+            heapq.heappush(self.waiting, ticket)
+            while not self.free or self.waiting[0] != ticket:
+                self.condition.wait()
+            heapq.heappop(self.waiting)
+            slot = self.free.pop(0)
+            # The next waiter in line may find another free slot.
+            self.condition.notify_all()
+            return slot
+
+    def release(self, slot):
+        with self.condition:
+            self.free.append(slot)
+            self.free.sort()
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, priority=0):
+        slot = self.acquire(priority)
+        try:
+            yield slot
+        finally:
+            self.release(slot)
+
+
+class DeviceThrottle(object):
+    # Caps how many threads read from each storage device at once, apart from
+    # how many encode, so that a spinning disk or a network mount serves a
+    # few long sequential reads rather than thrashing between every encoder's
+    # file. Any number of readers per device below 1 means no cap.
+    def __init__(self, readers_per_device=1):
+        self.readers_per_device = readers_per_device
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def reading(self, path):
+        if self.readers_per_device < 1:
+            yield
+            return
+        device = os.stat(path).st_dev
+        with self.lock:
+            if device not in self.semaphores:
+                self.semaphores[device] = threading.Semaphore(
+                    self.readers_per_device)
+            semaphore = self.semaphores[device]
+        with semaphore:
+            yield
+
+
+def read_ahead(path, chunk_size=READ_AHEAD_CHUNK):
+    # Pulls a whole file into the page cache with large sequential reads.
+    with open(path, 'rb') as source:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(source.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(source.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        while source.read(chunk_size):
+            pass
+
+
+class Prefetcher(object):
+    # Reads tracks into the page cache on a thread of its own, in the order
+    # the encoders will take them, so that encoders find their input in
+    # memory instead of waiting on the disk. At most budget bytes are read
+    # ahead of the encoders (but always at least one track); reads go
+    # through the device throttle.
+    def __init__(self, paths, throttle, budget):
+        self.paths = paths
+        self.throttle = throttle
+        self.budget = budget
+        self.ready = dict((path, threading.Event()) for path in paths)
+        self.sizes = {}
+        self.ahead = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._prefetch_all)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def wait(self, path):
+        self.ready[path].wait()
+
+    def consumed(self, path):
+        with self.condition:
+            self.ahead -= self.sizes.pop(path, 0)
+            self.condition.notify_all()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for event in self.ready.values():
+            event.set()
+
+    def _prefetch_all(self):
+        for path in self.paths:
+            try:
+                size = os.path.getsize(path)
+                with self.condition:
+                    while (not self.stopped and self.ahead and
+                           self.ahead + size > self.budget):
+                        self.condition.wait()
+                    if self.stopped:
+                        return
+                    self.sizes[path] = size
+                    self.ahead += size
+                with self.throttle.reading(path):
+                    read_ahead(path)
+            except (IOError, OSError):
+                # The encoder reports unreadable tracks itself.
+                pass
+            finally:
+                self.ready[path].set()
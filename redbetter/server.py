@@ -0,0 +1,281 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import errno
+import itertools
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+from six.moves import queue
+from six.moves import socketserver
+
+from redbetter.compat import print_bytes as printb
+from redbetter.compat import to_bytes
+from redbetter.compat import to_unicode
+from redbetter.progress import Progress
+from redbetter.scheduler import DeviceThrottle
+from redbetter.scheduler import SlotPool
+from redbetter.toolchain import Toolchain
+from redbetter.trace import Tracer
+from redbetter.transcode import Defaults
+from redbetter.transcode import Job
+from redbetter.utils import ProbeCache
+
+
+# The protocol is one JSON object per line in each direction. A client sends
+# a single request:
+#   {"command": "submit", "job": {<Job keyword arguments>}, "priority": 0,
+#    "wait": true}
+#   {"command": "wait", "id": 1}
+#   {"command": "status"}
+# and the server answers "submit" with {"event": "job_submitted", "id": N},
+# "status" with {"event": "status", "jobs": [...]}, and streams a waiting
+# client every progress event of the job (see redbetter.progress) until
+# {"event": "job_finished", "id": N, "exit_code": N}, along with every line the
+# job logs as {"event": "message", "id": N, "message": "..."}.
+JOB_SUBMITTED = 'job_submitted'
+JOB_FINISHED = 'job_finished'
+STATUS = 'status'
+MESSAGE = 'message'
+ERROR = 'error'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+
+
+class SubmittedJob(object):
+    def __init__(self, id, arguments, priority):
+        self.id = id
+        self.arguments = arguments
+        self.priority = priority
+        self.state = QUEUED
+        self.exit_code = None
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def listen(self):
+        listener = queue.Queue()
+        with self.lock:
+            if self.state == FINISHED:
+                listener.put(self.finished_event())
+            else:
+                self.listeners.append(listener)
+        return listener
+
+    def unlisten(self, listener):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def publish(self, event):
+        with self.lock:
+            for listener in self.listeners:
+                listener.put(event)
+
+    def finish(self, exit_code):
+        with self.lock:
+            self.state = FINISHED
+            self.exit_code = exit_code
+            for listener in self.listeners:
+                listener.put(self.finished_event())
+            self.listeners = []
+
+    def finished_event(self):
+        return {'event': JOB_FINISHED, 'id': self.id,
+                'exit_code': self.exit_code}
+
+    def status(self):
+        return {'id': self.id, 'state': self.state, 'priority': self.priority,
+                'albums': self.arguments.get('albums', []),
+                'exit_code': self.exit_code}
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # Runs every submitted job in this one process, on one pool of encoder
+    # slots sized for the machine, one pool of torrent threads, and with
+    # tools looked up and tracks probed once, so that concurrent submissions
+    # share the CPU instead of oversubscribing it.
+    daemon_threads = True
+
+    def __init__(self, path, cores, tracer=None,
+                 torrent_threads=Defaults.torrent_threads,
+                 readers_per_device=Defaults.readers_per_device,
+                 toolchain_cache=Defaults.toolchain_cache):
+        # The shared pools are sized by the server's own options; those of
+        # submitted jobs don't apply to them.
+        self.slots = SlotPool(cores)
+        self.toolchain = Toolchain(
+            os.path.expanduser(toolchain_cache) if toolchain_cache else None)
+        self.torrent_pool = ThreadPool(max(1, torrent_threads))
+        self.probe_cache = ProbeCache()
+        self.throttle = DeviceThrottle(readers_per_device)
+        # Without a server-wide tracer, each job may trace to its own file.
+        self.tracer = tracer
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.jobs_lock = threading.Lock()
+        remove_stale_socket(path)
+        # Only the owner may submit jobs.
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, JobHandler)
+        finally:
+            os.umask(umask)
+
+    def submit(self, arguments, priority, listen=False):
+        # Returns the submitted job and, with listen, a queue of its events
+        # from the very first one on.
+        with self.jobs_lock:
+            submitted = SubmittedJob(next(self.ids), arguments, priority)
+            self.jobs[submitted.id] = submitted
+        listener = submitted.listen() if listen else None
+        thread = threading.Thread(target=self.run_job, args=(submitted,))
+        thread.daemon = True
+        thread.start()
+        return submitted, listener
+
+    def run_job(self, submitted):
+        submitted.state = RUNNING
+        printb('Starting job %d' % (submitted.id))
+
+        # What the job logs goes to its clients rather than the server's
+        # output, which only they could make sense of.
+        def log(*args):
+            submitted.publish({'event': MESSAGE, 'id': submitted.id,
+                               'message': ' '.join(to_unicode(a) for a in args)})
+
+        try:
+            job = Job(progress=Progress(callback=submitted.publish),
+                      log=log,
+                      slots=self.slots,
+                      toolchain=self.toolchain,
+                      torrent_pool=self.torrent_pool,
+                      probe_cache=self.probe_cache,
+                      throttle=self.throttle,
+                      tracer=self.tracer,
+                      priority=submitted.priority,
+                      **submitted.arguments)
+            exit_code = job.run().exit_code
+        except Exception as e:
+            printb('Job %d failed' % (submitted.id))
+            print(e)
+            exit_code = -1
+        printb('Finished job %d with code %d' % (submitted.id, exit_code))
+        submitted.finish(exit_code)
+
+    def status(self):
+        with self.jobs_lock:
+            return [self.jobs[id].status() for id in sorted(self.jobs)]
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def send(self, message):
+        self.wfile.write(to_bytes(json.dumps(message) + '\n'))
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            request = json.loads(to_unicode(self.rfile.readline()))
+            command = request.get('command')
+            if command == 'submit':
+                submitted, listener = self.server.submit(
+                    request.get('job', {}), request.get('priority', 0),
+                    request.get('wait'))
+                self.send({'event': JOB_SUBMITTED, 'id': submitted.id})
+                if listener is not None:
+                    self.stream(submitted, listener)
+            elif command == 'wait':
+                submitted = self.server.jobs.get(request.get('id'))
+                if submitted is None:
+                    self.send({'event': ERROR, 'message': 'No such job'})
+                else:
+                    self.stream(submitted, submitted.listen())
+            elif command == 'status':
+                self.send({'event': STATUS, 'jobs': self.server.status()})
+            else:
+                self.send({'event': ERROR, 'message': 'Unknown command'})
+        except (IOError, OSError, ValueError):
+            # The client went away or sent garbage; its job, if any, goes on.
+            pass
+
+    def stream(self, submitted, listener):
+        try:
+            while True:
+                event = listener.get()
+                self.send(event)
+                if event['event'] == JOB_FINISHED:
+                    return
+        finally:
+            submitted.unlisten(listener)
+
+
+def remove_stale_socket(path):
+    if not os.path.exists(path):
+        return
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket.error as e:
+        if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+            os.remove(path)
+            return
+        raise
+    finally:
+        client.close()
+    raise IOError(errno.EADDRINUSE, 'A server is already listening', path)
+
+
+def serve(path, cores, trace='', **options):
+    # trace, if given, is a file to write a timeline of every job to on exit;
+    # options are those of JobServer.
+    tracer = Tracer(trace) if trace else None
+    server = JobServer(path, cores, tracer, **options)
+    printb('Serving on %s with %d encoder slots' % (path, cores))
+    # Unwind on SIGTERM too, so that the socket file is removed.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+        if tracer is not None:
+            tracer.save()
+
+
+def request(path, message):
+    # Sends one request and yields every message of the answer.
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    try:
+        client.sendall(to_bytes(json.dumps(message) + '\n'))
+        for line in client.makefile('rb'):
+            yield json.loads(to_unicode(line))
+    finally:
+        client.close()
+
+
+def submit(path, arguments, priority=0, wait=True, on_event=None):
+    # Returns the job's exit code when waiting, and 0 once it was accepted
+    # otherwise.
+    for message in request(path, {'command': 'submit', 'job': arguments,
+                                  'priority': priority, 'wait': wait}):
+        if message['event'] == JOB_SUBMITTED:
+            printb('Submitted job %d' % (message['id']))
+            if not wait:
+                return 0
+        elif message['event'] == JOB_FINISHED:
+            return message['exit_code']
+        elif message['event'] == MESSAGE:
+            printb(message['message'])
+        elif on_event is not None:
+            on_event(message)
+    printb('Lost the connection to the server')
+    return -1
@@ -0,0 +1,126 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import subprocess
+
+from redbetter.compat import get_numpy
+from redbetter.utils import get_duration
+from redbetter.utils import probe
+
+
+# Tracks are decoded to mono 16-bit PCM at this rate. Every shelf below lies
+# under its Nyquist frequency, so sources at other rates can be resampled to
+# it without hiding a cutoff.
+SAMPLE_RATE = 44100
+
+# The STFT frame length and how many frames are read from the decoder at a
+# time; memory use is bounded by their product, whatever the track length.
+FRAME_SIZE = 4096
+FRAMES_PER_CHUNK = 64
+
+# The lowpass frequencies (Hz) typical lossy encoders leave behind: ~16 kHz
+# for 128 kbps MP3, ~19 kHz for V0/V2 and ~20 kHz for 320 kbps.
+SHELVES = (16000, 19000, 20000)
+
+# The width (Hz) of the bands compared on either side of a shelf, the gap
+# (Hz) left between them for the encoder's transition band and the window's
+# leakage, and how many dB quieter the band above must be for the shelf to
+# count as a cutoff.
+BAND_WIDTH = 1500
+BAND_GAP = 250
+CUTOFF_DROP = 30.0
+
+# Only this many seconds from the middle of each track are analysed by
+# default, enough to see a cutoff without decoding whole albums.
+ANALYSIS_SECONDS = 60
+
+
+def decode_command(filename, seconds, duration=None):
+    command = ['ffmpeg', '-v', '0']
+    if seconds:
+        if duration is None:
+            duration = get_duration(probe(filename))
+        if duration > seconds:
+            command += ['-ss', '%.3f' % ((duration - seconds) / 2)]
+        command += ['-t', '%d' % (seconds)]
+    return command + ['-i', filename, '-ac', '1', '-ar', '%d' % (SAMPLE_RATE),
+                      '-f', 's16le', '-']
+
+
+def power_spectrum(filename, seconds=ANALYSIS_SECONDS, duration=None):
+    # Streams the decoded track through a Hann-windowed STFT and returns the
+    # mean power of every frequency bin, or None if nothing could be decoded.
+    numpy = get_numpy()
+    window = numpy.hanning(FRAME_SIZE).astype(numpy.float32)
+    total = numpy.zeros(FRAME_SIZE // 2 + 1)
+    frames = 0
+    chunk_bytes = FRAME_SIZE * FRAMES_PER_CHUNK * 2
+
+    process = subprocess.Popen(decode_command(filename, seconds, duration),
+                               stdout=subprocess.PIPE)
+    try:
+        while True:
+            data = process.stdout.read(chunk_bytes)
+            count = len(data) // (FRAME_SIZE * 2)
+            if count == 0:
+                break
+            samples = numpy.frombuffer(data[:count * FRAME_SIZE * 2],
+                                       dtype='<i2')
+            samples = samples.reshape(count, FRAME_SIZE).astype(numpy.float32)
+            spectrum = numpy.fft.rfft(samples * window, axis=1)
+            total += (spectrum.real ** 2 + spectrum.imag ** 2).sum(axis=0)
+            frames += count
+    finally:
+        process.stdout.close()
+        process.wait()
+
+    if frames == 0:
+        return None
+    return total / frames
+
+
+def band_power(spectrum, low, high):
+    # The median ignores the odd loud bin, e.g. a pilot tone or leakage.
+    hz_per_bin = SAMPLE_RATE / FRAME_SIZE
+    return get_numpy().median(spectrum[int(low / hz_per_bin):int(high / hz_per_bin)])
+
+
+def find_cutoff(spectrum):
+    # Returns the lowest shelf with a cliff in the spectrum above it, and the
+    # drop in dB measured at every shelf.
+    numpy = get_numpy()
+    drops = {}
+    cutoff = None
+    for shelf in SHELVES:
+        below = band_power(spectrum, shelf - BAND_GAP - BAND_WIDTH,
+                           shelf - BAND_GAP)
+        above = band_power(spectrum, shelf + BAND_GAP,
+                           shelf + BAND_GAP + BAND_WIDTH)
+        # Digital silence above the shelf is the clearest cliff of all.
+        drop = 10 * numpy.log10((below + 1e-9) / (above + 1e-9))
+        drops[shelf] = float(drop)
+        if cutoff is None and below > 0 and drop >= CUTOFF_DROP:
+            cutoff = shelf
+    return cutoff, drops
+
+
+def analyze_track(filename, seconds=ANALYSIS_SECONDS, duration=None):
+    # duration, in seconds, saves probing the track again if already known.
+    spectrum = power_spectrum(filename, seconds, duration)
+    if spectrum is None:
+        return {'file': filename, 'cutoff': None, 'drops': {}, 'error': True}
+    cutoff, drops = find_cutoff(spectrum)
+    return {'file': filename, 'cutoff': cutoff, 'drops': drops,
+            'error': False}
+
+
+def looks_lossy(results):
+    # An album looks transcoded from a lossy source when at least half of
+    # its analysed tracks have a cutoff.
+    analysed = [result for result in results if not result['error']]
+    if not analysed:
+        return False
+    cut = [result for result in analysed if result['cutoff'] is not None]
+    return len(cut) * 2 >= len(analysed)
@@ -0,0 +1,108 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import os
+import shutil
+import threading
+
+from six.moves import queue
+
+from redbetter.compat import print_bytes as printb
+from redbetter.utils import link_or_copy
+
+
+def directory_size(directory, files):
+    return sum(os.path.getsize(directory + '/' + file) for file in files)
+
+
+class Staging(object):
+    # Transcodes are encoded into a local scratch directory and published to
+    # their final location afterwards, so slow network storage only ever sees
+    # one sequential copy per album and never a half-written album. A single
+    # publisher thread copies albums one at a time while encoding goes on.
+    #
+    # limit bounds the bytes held in scratch (0 for no bound): reserve()
+    # blocks until enough earlier albums have been published to make room.
+    #
+    # Staged files that are unchanged copies of a source file can be named in
+    # publish()'s links: when the album has to be copied to another
+    # filesystem, they are linked from the source there instead, as they
+    # would have been without staging.
+    def __init__(self, scratch, limit=0, log=printb):
+        self.scratch = scratch
+        self.limit = limit
+        self.log = log
+        self.used = 0
+        self.failed = []
+        self.condition = threading.Condition()
+        self.pending = queue.Queue()
+        self.publisher = None
+
+    def staged_path(self, final):
+        return os.path.join(self.scratch, os.path.basename(final))
+
+    def reserve(self, size):
+        with self.condition:
+            # An album bigger than the whole limit still goes through, alone.
+            while self.limit and self.used and self.used + size > self.limit:
+                self.log('Waiting for scratch space to be freed...')
+                self.condition.wait()
+            self.used += size
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+    def publish(self, staged, final, size, links=None):
+        # links maps staged file paths to the source files they are copies of.
+        if self.publisher is None:
+            self.publisher = threading.Thread(target=self._publish_all)
+            self.publisher.daemon = True
+            self.publisher.start()
+        self.pending.put((staged, final, size, links or {}))
+
+    def discard(self, staged, size):
+        shutil.rmtree(staged, ignore_errors=True)
+        self.release(size)
+
+    def wait(self):
+        # Blocks until everything handed to publish() is in place and returns
+        # the final paths that could not be published.
+        self.pending.join()
+        return self.failed
+
+    def _publish_all(self):
+        while True:
+            staged, final, size, links = self.pending.get()
+            try:
+                self._publish(staged, final, links)
+            except (IOError, OSError) as e:
+                self.log('Could not publish %s to %s' % (staged, final))
+                self.log(str(e))
+                self.failed.append(final)
+            finally:
+                self.release(size)
+                self.pending.task_done()
+
+    def _publish(self, staged, final, links):
+        parent = os.path.dirname(final)
+        if os.stat(self.scratch).st_dev == os.stat(parent).st_dev:
+            os.rename(staged, final)
+        else:
+            # Copy under a hidden name first; the rename on the destination
+            # filesystem makes the album appear complete or not at all.
+            partial = os.path.join(parent, '.%s.partial' % (
+                os.path.basename(final)))
+            if os.path.exists(partial):
+                shutil.rmtree(partial)
+            shutil.copytree(staged, partial, ignore=lambda directory, names: [
+                name for name in names
+                if os.path.join(directory, name) in links])
+            for path, source in links.items():
+                link_or_copy(source, partial + path[len(staged):])
+            os.rename(partial, final)
+            shutil.rmtree(staged)
+        self.log('Published ' + final)
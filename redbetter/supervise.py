@@ -0,0 +1,85 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import os
+import signal
+import subprocess
+import tempfile
+import time
+
+from redbetter.compat import new_session
+from redbetter.compat import to_unicode
+
+
+# How often, in seconds, a running command is checked against its deadline.
+POLL_SECONDS = 0.05
+
+# The bytes per second of audio assumed for a track that couldn't be probed:
+# CD audio at about half its size, which overestimates the length of any
+# compressed or high resolution track and so errs on the long side.
+BYTES_PER_AUDIO_SECOND = 88200
+
+
+def task_timeout(seconds, size, factor, minimum):
+    # The wall-clock seconds a track's encoder may take: minimum, plus factor
+    # times the track's length in seconds (estimated from its size when
+    # unknown). None if factor isn't positive, i.e. for no limit.
+    if factor <= 0:
+        return None
+    if not seconds:
+        seconds = size / BYTES_PER_AUDIO_SECOND
+    return minimum + factor * seconds
+
+
+def run_command(command, timeout=None, show_output=False):
+    # Runs a shell command and returns (returncode, stderr, timed_out). Once
+    # timeout seconds have passed, the whole pipeline is killed. stdout is
+    # discarded unless show_output is set.
+    with open(os.devnull, 'wb') as devnull, tempfile.TemporaryFile() as stderr:
+        # stderr goes to a file so that nothing has to read a pipe while the
+        # deadline is watched, and a new session lets every process of a
+        # pipeline (e.g. flac | lame) be killed at once.
+        process = subprocess.Popen(
+            command, stdin=None, stdout=None if show_output else devnull,
+            stderr=stderr, shell=True, **new_session)
+        timed_out = False
+        try:
+            if timeout is None:
+                process.wait()
+            else:
+                deadline = time.time() + timeout
+                while process.poll() is None:
+                    if time.time() >= deadline:
+                        timed_out = True
+                        break
+                    time.sleep(POLL_SECONDS)
+        finally:
+            if process.poll() is None:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                process.wait()
+
+        stderr.seek(0)
+        return process.returncode, to_unicode(stderr.read()), timed_out
+
+
+def run_with_retries(command, timeout=None, retries=0, backoff=0,
+                     show_output=False, before_retry=None):
+    # Runs a command until it exits with 0, at most 1 + retries times, waiting
+    # backoff seconds before the first retry and twice as long before each
+    # next one. before_retry is called with the failed attempt's returncode,
+    # stderr and whether it timed out, e.g. to remove partial output. Returns
+    # (returncode, stderr, timed_out, attempts) of the last attempt.
+    attempt = 1
+    while True:
+        returncode, stderr, timed_out = run_command(command, timeout, show_output)
+        if returncode == 0 or attempt > retries:
+            return returncode, stderr, timed_out, attempt
+        if before_retry is not None:
+            before_retry(returncode, stderr, timed_out)
+        time.sleep(backoff * 2 ** (attempt - 1))
+        attempt += 1
@@ -0,0 +1,183 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import io
+import json
+import os
+import subprocess
+import threading
+
+from redbetter.compat import to_unicode
+from redbetter.compat import which
+from redbetter.utils import base_command
+
+
+CACHE_VERSION = 1
+
+# How to ask each known tool for its version; the first line of its output
+# is kept. Other tools are found but their version isn't asked for.
+VERSION_ARGUMENTS = {
+    'ffmpeg': ['-version'],
+    'ffprobe': ['-version'],
+    'flac': ['--version'],
+    'lame': ['--version'],
+    'mktorrent': ['-h'],
+    'transmission-create': ['--version'],
+}
+
+
+def pipeline_commands(command_with_arguments):
+    # The program run by every stage of a shell pipeline, e.g. flac and lame.
+    return [base_command(stage) for stage in command_with_arguments.split('|')
+            if stage.strip()]
+
+
+def tool_version(path, name):
+    arguments = VERSION_ARGUMENTS.get(name)
+    if arguments is None:
+        return None
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            process = subprocess.Popen([path] + arguments, stdin=devnull,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            output = process.communicate()[0]
+    except OSError:
+        return None
+    lines = to_unicode(output).strip().splitlines()
+    return lines[0].strip() if lines else None
+
+
+def path_key():
+    # Tools appear, disappear or are upgraded when a directory on PATH or a
+    # binary changes, so the PATH value and the mtimes of its directories
+    # decide whether a cache is still valid; those of the binaries are
+    # checked on top.
+    path = os.environ.get('PATH', os.defpath)
+    mtimes = []
+    for directory in path.split(os.pathsep):
+        try:
+            mtimes.append(os.stat(directory).st_mtime)
+        except OSError:
+            mtimes.append(None)
+    return {'path': path, 'mtimes': mtimes}
+
+
+class Toolchain(object):
+    # Remembers where each external tool was found so that checking the
+    # encoder of every format of every album doesn't search PATH again. One
+    # instance can be shared by any number of jobs and threads.
+    #
+    # With a cache_file, what probe() finds (paths and versions) is kept on
+    # disk and reused by later runs until PATH or the binaries change, so
+    # short runs don't search PATH or start every tool to learn its version.
+    def __init__(self, cache_file=None):
+        self.paths = {}
+        self.versions = {}
+        self.lock = threading.Lock()
+        self.torrent_commands = {}
+        self.cache_file = cache_file
+        self.loaded = False
+
+    def which(self, name):
+        with self.lock:
+            if name not in self.paths:
+                self.paths[name] = which(name)
+            return self.paths[name]
+
+    def version(self, name):
+        return self.versions.get(name)
+
+    def command_exists(self, command_with_arguments):
+        return all(self.which(name) is not None
+                   for name in pipeline_commands(command_with_arguments))
+
+    def find_torrent_command(self, commands):
+        key = tuple(sorted(commands))
+        if key not in self.torrent_commands:
+            self.torrent_commands[key] = None
+            for command in commands:
+                if self.command_exists(command):
+                    self.torrent_commands[key] = command
+                    break
+        return self.torrent_commands[key]
+
+    def probe(self, commands):
+        # Looks up every program the commands run, and their versions, at
+        # once; from the cache file when it is still valid.
+        names = set()
+        for command in commands:
+            names.update(pipeline_commands(command))
+
+        with self.lock:
+            if not self.loaded:
+                self.loaded = True
+                self.load()
+            missing = [name for name in sorted(names)
+                       if name not in self.paths or
+                       (self.paths[name] and name not in self.versions)]
+            for name in missing:
+                self.paths[name] = which(name)
+                if self.paths[name]:
+                    self.versions[name] = tool_version(self.paths[name], name)
+            if missing:
+                self.save()
+
+    def load(self):
+        if not self.cache_file:
+            return
+        # A cache that can't be read or doesn't make sense, e.g. because it
+        # is a directory, unreadable or truncated, is only a miss: the tools
+        # are searched for again and save() replaces it.
+        try:
+            with io.open(self.cache_file, encoding='utf-8') as cache:
+                data = json.load(cache)
+        except (IOError, OSError, ValueError):
+            return
+        if (not isinstance(data, dict) or
+                data.get('version') != CACHE_VERSION or
+                data.get('key') != path_key()):
+            return
+        tools = data.get('tools')
+        if not isinstance(tools, dict):
+            return
+        for name, tool in tools.items():
+            try:
+                path, mtime = tool['path'], tool['mtime']
+                version = tool['version']
+                if path is not None and os.stat(path).st_mtime != mtime:
+                    continue
+            except (KeyError, TypeError, ValueError, OSError):
+                continue
+            self.paths[name] = path
+            self.versions[name] = version
+
+    def save(self):
+        if not self.cache_file:
+            return
+        tools = {}
+        for name, path in self.paths.items():
+            try:
+                mtime = os.stat(path).st_mtime if path else None
+            except OSError:
+                continue
+            tools[name] = {'path': path, 'mtime': mtime,
+                           'version': self.versions.get(name)}
+
+        # Several runs may start at once, e.g. from cron; the last to finish
+        # wins and nobody reads a half-written file.
+        try:
+            directory = os.path.dirname(self.cache_file)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            temporary = '%s.%d.tmp' % (self.cache_file, os.getpid())
+            with io.open(temporary, 'w', encoding='utf-8') as cache:
+                cache.write(to_unicode(json.dumps(
+                    {'version': CACHE_VERSION, 'key': path_key(),
+                     'tools': tools})))
+            os.rename(temporary, self.cache_file)
+        except (IOError, OSError):
+            # A read-only home only costs the next run a PATH search.
+            pass
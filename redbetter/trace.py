@@ -0,0 +1,143 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import io
+import itertools
+import json
+import os
+import threading
+import time
+
+from redbetter.compat import to_unicode
+
+
+# Spans are written as Chrome trace events (complete 'X' events), which
+# chrome://tracing and ui.perfetto.dev open as a timeline. Work done on an
+# encoder slot is drawn on that slot's row, so gaps in the rows are idle
+# slots; everything else (copies, torrents, ...) is drawn on a row per
+# thread.
+SLOT_ROWS = 0
+THREAD_ROWS = 1000
+
+
+class NoSpan(object):
+    # What a disabled tracer hands out: entering and leaving it does nothing.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+class Span(object):
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args['error'] = to_unicode(str(exc_value))
+        self.tracer.record(self.name, self.start, time.time(), self.args)
+        return False
+
+
+class SlotContext(object):
+    def __init__(self, tracer, slot):
+        self.tracer = tracer
+        self.slot = slot
+
+    def __enter__(self):
+        self.previous = getattr(self.tracer.local, 'slot', None)
+        self.tracer.local.slot = self.slot
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.local.slot = self.previous
+        return False
+
+
+class Tracer(object):
+    # Collects spans from any number of threads and jobs, and writes them to
+    # filename on save(). Without a filename nothing is recorded.
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.enabled = bool(filename)
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.thread_rows = {}
+        self.rows = itertools.count(THREAD_ROWS)
+        self.start = time.time()
+
+    def span(self, name, **args):
+        # Used as "with tracer.span('encode', album=..., file=...):".
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name, args)
+
+    def on_slot(self, slot):
+        # Spans of the current thread are drawn on slot's row until the
+        # returned context is left.
+        if not self.enabled:
+            return NO_SPAN
+        return SlotContext(self, slot)
+
+    def record(self, name, start, end, args):
+        slot = getattr(self.local, 'slot', None)
+        if slot is not None:
+            args['slot'] = slot
+            row = SLOT_ROWS + slot
+        else:
+            row = self.thread_row()
+        with self.lock:
+            self.events.append({
+                'name': name,
+                'cat': 'redbetter',
+                'ph': 'X',
+                'ts': (start - self.start) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': os.getpid(),
+                'tid': row,
+                'args': args,
+            })
+
+    def thread_row(self):
+        thread = threading.current_thread()
+        with self.lock:
+            if thread.ident not in self.thread_rows:
+                self.thread_rows[thread.ident] = (next(self.rows), thread.name)
+            return self.thread_rows[thread.ident][0]
+
+    def save(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            events = list(self.events)
+            rows = dict(self.thread_rows)
+        slots = set(event['args']['slot'] for event in events
+                    if 'slot' in event['args'])
+        names = [(SLOT_ROWS + slot, 'slot %d' % (slot)) for slot in slots]
+        names += list(rows.values())
+        for row, name in sorted(names):
+            events.append({'name': 'thread_name', 'ph': 'M',
+                           'pid': os.getpid(), 'tid': row,
+                           'args': {'name': name}})
+            events.append({'name': 'thread_sort_index', 'ph': 'M',
+                           'pid': os.getpid(), 'tid': row,
+                           'args': {'sort_index': row}})
+
+        temporary = '%s.%d.tmp' % (self.filename, os.getpid())
+        with io.open(temporary, 'w', encoding='utf-8') as output:
+            output.write(to_unicode(json.dumps(
+                {'traceEvents': events, 'displayTimeUnit': 'ms'})))
+        os.rename(temporary, self.filename)
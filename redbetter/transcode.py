@@ -6,34 +6,68 @@ from __future__ import unicode_literals
 import multiprocessing
 import os
 import re
-import subprocess
+import shutil
+import socket
 import sys
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 
 from redbetter.bencode import Bencode
 from redbetter.compat import print_bytes as printb
 from redbetter.compat import to_unicode
-from redbetter.compat import mutagen
-from redbetter.errors import ARG_NOT_DIRECTORY
+from redbetter.compat import get_mutagen
+from redbetter.compat import get_numpy
 from redbetter.errors import FILE_NOT_FOUND
+from redbetter.errors import LOSSY_MASTER
 from redbetter.errors import NO_ANNOUNCE_URL
 from redbetter.errors import NO_TORRENT_CLIENT
 from redbetter.errors import NO_TRANSCODER
+from redbetter.errors import PUBLISH_ERROR
 from redbetter.errors import SOURCE_EMBED_ERROR
+from redbetter.errors import TIMEOUT_ERROR
 from redbetter.errors import TORRENT_ERROR
 from redbetter.errors import TRANSCODE_AGAINST_RULES
 from redbetter.errors import TRANSCODE_DIR_EXISTS
 from redbetter.errors import TRANSCODE_ERROR
 from redbetter.errors import UNKNOWN_TRANSCODE
+from redbetter.errors import exit_status
+from redbetter.progress import ALBUM_FINISHED
+from redbetter.progress import BATCH_QUEUED
+from redbetter.progress import FORMAT_FINISHED
+from redbetter.progress import Progress
+from redbetter.progress import TASK_FAILED
+from redbetter.progress import TASK_FINISHED
+from redbetter.progress import TASK_QUEUED
+from redbetter.progress import TASK_RETRIED
+from redbetter.progress import TASK_STARTED
+from redbetter.result import Result
+from redbetter.scheduler import DeviceThrottle
+from redbetter.scheduler import Prefetcher
+from redbetter.scheduler import SlotPool
+from redbetter.spectral import ANALYSIS_SECONDS
+from redbetter.spectral import analyze_track
+from redbetter.spectral import looks_lossy
+from redbetter.staging import Staging
+from redbetter.staging import directory_size
+from redbetter.supervise import run_with_retries
+from redbetter.supervise import task_timeout
+from redbetter.toolchain import Toolchain
+from redbetter.trace import Tracer
 from redbetter.utils import base_command
-from redbetter.utils import command_exists
+from redbetter.utils import copy_album_art
 from redbetter.utils import copy_contents
-from redbetter.utils import find_torrent_command
+from redbetter.utils import get_audio_spec
+from redbetter.utils import get_duration
 from redbetter.utils import get_tags
+from redbetter.utils import ProbeCache
 from redbetter.utils import format_command
+from redbetter.utils import link_or_copy
 from redbetter.utils import adjust_prefixes
 from redbetter.utils import enumerate_contents
 from redbetter.utils import normalize_directory_path
+from redbetter.workqueue import POLL_SECONDS
+from redbetter.workqueue import WorkQueue
 
 class Defaults(object):
     # Your unique announce URL
@@ -62,6 +96,52 @@ class Defaults(object):
     prefix = ''
     # A source to embed in the generated torrent files.
     source = ''
+    # A work queue directory on a filesystem shared with other hosts. When
+    # set, tracks are published there for redbetter-worker processes to encode
+    # instead of being encoded on this host. Empty to encode locally.
+    queue_dir = ''
+    # A local scratch (e.g. tmpfs) directory to encode into before moving each
+    # finished album to the transcode output in one go. Empty to encode
+    # straight into the transcode output.
+    scratch_dir = ''
+    # The most MiB of albums to keep in the scratch directory at once; 0 for
+    # no limit.
+    scratch_limit = 0
+    # The number of .torrent files to create at once, alongside transcoding.
+    # Any number less than 1 creates each one inline, pausing transcoding.
+    torrent_threads = 2
+    # Whether to look for the cutoff left by a lossy encoder in the spectrum
+    # of each album before transcoding it (needs NumPy): '' not to, 'flag' to
+    # warn about albums that look transcoded, 'skip' to also skip them.
+    spectral_check = ''
+    # How many seconds from the middle of each track to analyse; 0 for all.
+    spectral_seconds = ANALYSIS_SECONDS
+    # The most threads to read source files from each disk or network mount
+    # at once, apart from the encoder threads. Any number less than 1 means
+    # no limit.
+    readers_per_device = 1
+    # The most MiB of upcoming tracks to read into memory ahead of the
+    # encoders; 0 to let each encoder read its own track.
+    prefetch_limit = 256
+    # How long each track's encoder may run before it is killed:
+    # timeout_minimum seconds plus timeout_factor seconds per second of
+    # audio. A timeout_factor less than or equal to 0 means no limit.
+    timeout_factor = 2
+    timeout_minimum = 60
+    # The seconds creating a .torrent file may take; 0 for no limit.
+    torrent_timeout = 1800
+    # How many more times to run an encoder or torrent client that failed or
+    # timed out, and the seconds to wait before the first retry; the wait
+    # doubles with every further retry.
+    retries = 2
+    retry_backoff = 2
+    # A file to write a Chrome trace-event timeline of every probe, copy,
+    # encode and torrent to, e.g. to see idle encoder slots. Empty for none.
+    trace = ''
+    # A file to remember where encoders and torrent clients were found, and
+    # their versions, across runs; it is refreshed whenever PATH or one of
+    # them changes. Empty to look them up on every run.
+    toolchain_cache = os.path.join('~', '.cache', 'redbetter', 'toolchain.json')
 
 
 class Job(object):
@@ -78,6 +158,40 @@ class Job(object):
             source=Defaults.source,
             torrent_output=Defaults.torrent_output,
             transcode_output=Defaults.transcode_output,
+            queue_dir=Defaults.queue_dir,
+            scratch_dir=Defaults.scratch_dir,
+            scratch_limit=Defaults.scratch_limit,
+            torrent_threads=Defaults.torrent_threads,
+            spectral_check=Defaults.spectral_check,
+            spectral_seconds=Defaults.spectral_seconds,
+            readers_per_device=Defaults.readers_per_device,
+            prefetch_limit=Defaults.prefetch_limit,
+            timeout_factor=Defaults.timeout_factor,
+            timeout_minimum=Defaults.timeout_minimum,
+            torrent_timeout=Defaults.torrent_timeout,
+            retries=Defaults.retries,
+            retry_backoff=Defaults.retry_backoff,
+            trace=Defaults.trace,
+            toolchain_cache=Defaults.toolchain_cache,
+            # A redbetter.progress.Progress to report transcoding events to.
+            progress=None,
+            # A redbetter.scheduler.SlotPool of encoder slots and a
+            # redbetter.toolchain.Toolchain, to share them with other jobs.
+            slots=None,
+            toolchain=None,
+            # Jobs with a lower priority get shared encoder slots first.
+            priority=0,
+            # A multiprocessing.pool.ThreadPool to create .torrent files on, a
+            # redbetter.utils.ProbeCache and a redbetter.scheduler.
+            # DeviceThrottle, to share them with other jobs.
+            torrent_pool=None,
+            probe_cache=None,
+            throttle=None,
+            # A redbetter.trace.Tracer to record spans to instead of one
+            # writing to trace, e.g. shared with other jobs.
+            tracer=None,
+            # Called like print with every message; prints by default.
+            log=None,
             # Currently calculated and passed by better.py. This interface
             # should be updated to take the same main arguments and calculate
             # these itself.
@@ -96,42 +210,130 @@ class Job(object):
         self.source = source
         self.torrent_output = torrent_output
         self.transcode_output = transcode_output
+        self.queue_dir = queue_dir
+        self.scratch_dir = scratch_dir
+        self.scratch_limit = scratch_limit
+        self.torrent_threads = torrent_threads
+        self.spectral_check = spectral_check
+        self.spectral_seconds = spectral_seconds
+        self.prefetch_limit = prefetch_limit
+        self.timeout_factor = timeout_factor
+        self.timeout_minimum = timeout_minimum
+        self.torrent_timeout = torrent_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.progress = progress or Progress()
+        self.slots = slots
+        self.toolchain = toolchain or Toolchain(
+            os.path.expanduser(toolchain_cache) if toolchain_cache else None)
+        self.priority = priority
+        self.torrents = torrent_pool
+        self.probe_cache = probe_cache or ProbeCache()
+        self.throttle = throttle or DeviceThrottle(readers_per_device)
+        self.tracer = tracer or Tracer(trace)
+        self.owns_tracer = tracer is None
+        self.log = log or printb
 
         self.explicit_torrent = explicit_torrent
         self.explicit_transcode = explicit_transcode
         self.original_torrent = original_torrent
 
         self.exit_code = 0
+        self.exit_code_lock = threading.Lock()
         self.torrent_command = None
+        self.queue = None
+        self.queued = []
+        self.staging = None
+        self.owns_torrents = torrent_pool is None
+        self.torrent_tasks = []
+        self.result = Result()
+        # Source tracks whose encoder failed on every attempt. They are not
+        # tried again for the album's other formats.
+        self.quarantined = set()
 
     def validate_arguments(self):
-        # Default to transcoding on one thread per core.
+        # Transcode formats, first: a typo fails at once, before any
+        # directory is checked or tool looked up.
+        bad_formats = []
+        valid_formats = []
+        for transcode_format in self.formats:
+            if transcode_format not in transcode_commands:
+                bad_formats.append(transcode_format)
+            else:
+                valid_formats.append(transcode_format)
+        if bad_formats:
+            self.fail(UNKNOWN_TRANSCODE)
+            self.log('Cannot transcode to the following formats:')
+            for bad_format in bad_formats:
+                self.log('\t%s' % (bad_format))
+            return False
+        self.formats = valid_formats
+
+        # Default to transcoding on one thread per core, or on every slot of
+        # a shared pool.
         if self.max_threads < 1:
-            self.max_threads = multiprocessing.cpu_count()
-            printb('Defaulting to transcoding using %d cores/threads' % (
-                self.max_threads))
+            if self.slots is not None:
+                self.max_threads = self.slots.size
+            else:
+                self.max_threads = multiprocessing.cpu_count()
+                self.log('Defaulting to transcoding using %d cores/threads' % (
+                    self.max_threads))
+        if self.slots is None:
+            self.slots = SlotPool(self.max_threads)
 
         # Check mutagen status.
-        if mutagen is None and ('v0' in formats or 'v2' in formats):
-            printb('Mutagen is not installed; album art cannot be copied to '
+        if ('v0' in self.formats or 'v2' in self.formats) and get_mutagen() is None:
+            self.log('Mutagen is not installed; album art cannot be copied to '
                    'VBR transcodes.')
-            printb('To keep album art, install mutagen using pip or apt-get')
+            self.log('To keep album art, install mutagen using pip or apt-get')
+
 
+        # Spectral check
+        if self.spectral_check and get_numpy() is None:
+            self.log('NumPy is not installed; albums cannot be checked for '
+                   'lossy sources.')
+            self.log('To check them, install numpy using pip or apt-get')
+            self.spectral_check = ''
 
         # Torrent output directory
         self.torrent_output = normalize_directory_path(self.torrent_output)
         if not os.path.isdir(self.torrent_output):
-            self.exit_code |= FILE_NOT_FOUND
-            printb('There is no torrent output directory: %s' % (
+            self.fail(FILE_NOT_FOUND)
+            self.log('There is no torrent output directory: %s' % (
                 self.torrent_output))
 
         # Transcode output directory
         self.transcode_output = normalize_directory_path(self.transcode_output)
         if not os.path.isdir(self.transcode_output):
-            self.exit_code |= FILE_NOT_FOUND
-            printb('There is no transcode output directory : %s' % (
+            self.fail(FILE_NOT_FOUND)
+            self.log('There is no transcode output directory : %s' % (
                 self.transcode_output))
 
+        # Work queue directory
+        if self.queue_dir:
+            self.queue_dir = normalize_directory_path(self.queue_dir)
+            if not os.path.isdir(self.queue_dir):
+                self.fail(FILE_NOT_FOUND)
+                self.log('There is no work queue directory: %s' % (
+                    self.queue_dir))
+            else:
+                self.queue = WorkQueue(self.queue_dir).setup()
+
+        # Scratch directory
+        if self.scratch_dir:
+            self.scratch_dir = normalize_directory_path(self.scratch_dir)
+            if not os.path.isdir(self.scratch_dir):
+                self.fail(FILE_NOT_FOUND)
+                self.log('There is no scratch directory: %s' % (
+                    self.scratch_dir))
+            elif self.queue_dir:
+                self.log('Workers write straight to the transcode output, '
+                       'ignoring the scratch directory')
+            else:
+                self.staging = Staging(self.scratch_dir,
+                                       self.scratch_limit * 1024 * 1024,
+                                       self.log)
+
         # Album paths
         bad_albums = []
         valid_albums = []
@@ -142,147 +344,535 @@ class Job(object):
             else:
                 valid_albums.append(album)
         if bad_albums:
-            self.exit_code |= FILE_NOT_FOUND
-            printb('The following albums are not directories:')
+            self.log('The following albums are not directories:')
             for bad_album in bad_albums:
-                printb('\t%s' % (bad_album))
+                self.log('\t%s' % (bad_album))
+                record = self.result.album(bad_album)
+                record.skipped = 'not a directory'
+                self.fail(FILE_NOT_FOUND, record)
         self.albums = valid_albums
 
-        # Transcode formats
-        bad_formats = []
-        valid_formats = []
-        for i, transcode_format in enumerate(self.formats):
-            f = transcode_format.lower()
-            if transcode_format not in transcode_commands:
-                bad_formats.append(transcode_format)
-            else:
-                valid_formats.append(transcode_format)
-        if bad_formats:
-            self.exit_code |= UNKNOWN_TRANSCODE
-            printb('Cannot transcode to the following formats:')
-            for bad_format in bad_formats:
-                printb('\t%s' % (bad_format))
-        self.formats = valid_formats
-
         if not self.announce:
             # Cannot create .torrent files without an announce url.
             if self.explicit_torrent:
-                printb('You cannot create torrents without first setting your announce URL')
-                self.exit_code |= NO_ANNOUNCE_URL
+                self.log('You cannot create torrents without first setting your announce URL')
+                self.fail(NO_ANNOUNCE_URL)
             else:
                 self.do_torrent = False
 
 
-        self.exit_if_error()
+        if self.exit_code != 0:
+            return False
+
+        # Every tool this job may run is looked up once, here.
+        self.toolchain.probe(self.tool_commands())
 
+        if self.spectral_check and not self.toolchain.command_exists('ffmpeg'):
+            self.log('ffmpeg is not installed; albums cannot be checked for '
+                   'lossy sources.')
+            self.spectral_check = ''
+
+        if self.do_torrent or self.original_torrent:
+            if self.torrents is None and self.torrent_threads >= 1:
+                self.torrents = ThreadPool(self.torrent_threads)
+
+        return True
+
+    def tool_commands(self):
+        commands = ['ffprobe']
+        if self.do_transcode:
+            commands += [transcode_commands[f] for f in self.formats]
+        if self.do_torrent or self.original_torrent:
+            commands += sorted(torrent_commands)
+        if self.spectral_check:
+            commands.append('ffmpeg')
+        return commands
 
     def start(self):
-        self.validate_arguments()
+        self.run()
+        self.exit()
+
+    def run(self):
+        # Processes every album and returns a redbetter.result.Result rather
+        # than exiting, so that a Job can be used from another program.
+        if not self.validate_arguments():
+            return self.result
+
+        # Tracks are queued one album and format at a time, so the ETA needs
+        # to know up front what the whole batch adds up to.
+        expected = {}
+        if self.progress.enabled:
+            for album in self.albums:
+                expected[to_unicode(album)] = self.expected_bytes(album)
+            self.progress.emit(BATCH_QUEUED, albums=len(self.albums),
+                               formats=len(self.formats),
+                               bytes=sum(expected.values()))
 
         first_print = True
         for album in self.albums:
             if not first_print:
-                printb('\n\n')
+                self.log('\n\n')
             first_print = False
 
             album = to_unicode(album)
-            printb('Processing', album)
+            self.log('Processing', album)
 
-            self.process_album(album, self.do_transcode, self.explicit_transcode, self.formats, self.do_torrent, self.explicit_torrent, self.original_torrent)
-        self.exit()
+            # One album going wrong in an unexpected way doesn't stop the rest.
+            try:
+                self.process_album(album, self.do_transcode, self.explicit_transcode, self.formats, self.do_torrent, self.explicit_torrent, self.original_torrent)
+            except Exception as e:
+                self.log('Could not process ' + album)
+                self.log(str(e))
+                self.fail(TRANSCODE_ERROR, self.result.album(album))
+            self.progress.emit(ALBUM_FINISHED, album=album,
+                               bytes=expected.get(album, 0))
+            self.finish_queued(wait=False)
+        self.finish_queued()
+        self.finish_torrents()
+        self.finish_staged()
+        if self.owns_tracer:
+            self.tracer.save()
+        return self.result
+
+    def expected_bytes(self, album):
+        # The size of an album's lossless tracks once per format, before it
+        # is known which formats are skipped or which tracks are linked.
+        if not self.do_transcode:
+            return 0
+        try:
+            return directory_size(album, enumerate_contents(album)[3]) * len(
+                self.formats)
+        except OSError:
+            return 0
 
     # noinspection PyUnresolvedReferences
-    def transcode_files(self, src, dst, files, command, extension):
+    def transcode_files(self, src, dst, files, command, extension,
+                        transcode_format=None):
         remaining = files[:]
-        transcoded = []
-        # TODO: use multiprocessing.ThreadPool instead
-        threads = [None] * self.max_threads
-        filenames = []
+        remaining_lock = threading.Lock()
+        filenames = [(src + '/' + file,
+                      dst + '/' + file[:file.rfind('.') + 1] + extension)
+                     for file in files]
 
-        transcoding = True
+        # Tracks are only probed up front when someone is listening, so the
+        # queued events can carry the audio length.
+        probed = {}
+        queued = {}
+        for file in remaining:
+            info = self.probe(src + '/' + file) if self.progress.enabled else {}
+            probed[file] = info
+            queued[file] = self.task_fields(src, transcode_format, file, info)
+            self.progress.emit(TASK_QUEUED, **queued[file])
 
-        while transcoding:
-            transcoding = False
+        # Tracks are taken from the end of the list, so they are read ahead
+        # in reverse.
+        prefetcher = None
+        if self.prefetch_limit > 0:
+            prefetcher = Prefetcher([src + '/' + file for file in reversed(remaining)],
+                                    self.throttle,
+                                    self.prefetch_limit * 1024 * 1024).start()
 
-            for i in range(len(threads)):
-                if threads[i] is None or threads[i].poll() is not None:
-                    if threads[i] is not None:
-                        if threads[i].poll() != 0:
-                            printb('Error transcoding, process exited with code {}'.format(threads[i].poll()))
-                            printb('stderr output...')
-                            printb(to_unicode(threads[i].communicate()[1]))
-                        # noinspection PyBroadException
-                        try:
-                            threads[i].kill()
-                        except Exception as _:
-                            pass
+        # Each thread takes an encoder slot from the (possibly shared) pool
+        # before taking the next track, so several jobs in one process never
+        # run more encoders than the pool has slots.
+        def transcode_remaining():
+            while True:
+                with self.slots.slot(self.priority) as slot, self.tracer.on_slot(slot):
+                    with remaining_lock:
+                        if not remaining:
+                            return
+                        file = remaining.pop()
+                        left = len(remaining)
+                    # An exception would end this thread and leave its
+                    # share of the tracks untouched.
+                    try:
+                        self.transcode_file(src, dst, file, command, extension,
+                                            transcode_format, probed[file], left,
+                                            prefetcher)
+                    except Exception as e:
+                        self.log('Could not transcode ' + file)
+                        self.log(str(e))
+                        self.fail(TRANSCODE_ERROR,
+                                  self.result.album(src).format(transcode_format))
+                        # Or the track stays remaining and inflates the ETA.
+                        self.progress.emit(TASK_FAILED, returncode=None,
+                                           error=to_unicode(str(e)),
+                                           **queued[file])
+                    finally:
+                        # Whatever happened, the track's read-ahead budget is
+                        # given back, or the prefetcher stalls the others.
+                        if prefetcher is not None:
+                            prefetcher.wait(src + '/' + file)
+                            prefetcher.consumed(src + '/' + file)
 
-                    threads[i] = None
+        threads = [threading.Thread(target=transcode_remaining)
+                   for _ in range(min(self.max_threads, len(files)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if prefetcher is not None:
+            prefetcher.stop()
 
-                    if len(remaining) > 0:
-                        transcoding = True
-                        file = remaining.pop()
-                        transcoded.append(dst + '/' + file[:file.rfind('.') + 1] + extension)
-                        threads[i] = subprocess.Popen(
-                            format_command(command, src + '/' + file, transcoded[-1], *get_tags(src + '/' + file)),
-                            stdin=None, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
-                            universal_newlines=True
-                        )
-                        filenames.append((src + '/' + file, transcoded[-1]))
-                        printb('Transcoding {} ({} remaining)'.format(to_unicode(file), len(remaining)))
-                else:
-                    transcoding = True
-
-            time.sleep(0.05)
-
-        for file in transcoded:
-            if not os.path.isfile(file):
-                printb('An error occurred and {} was not created'.format(file))
-                self.exit_code |= TRANSCODE_ERROR
+        record = self.result.album(src).format(transcode_format)
+        valid = self.check_transcodes(filenames, record)
+        self.progress.emit(FORMAT_FINISHED, album=src, format=transcode_format,
+                           destination=dst, ok=valid)
+        return valid
+
+    def transcode_file(self, src, dst, file, command, extension,
+                       transcode_format, info, remaining, prefetcher=None):
+        transcoded = dst + '/' + file[:file.rfind('.') + 1] + extension
+        info = info or self.probe(src + '/' + file)
+        fields = self.task_fields(src, transcode_format, file, info)
+
+        record = self.result.album(src).format(transcode_format)
+        file_record = record.file(src + '/' + file, transcoded)
+
+        if src + '/' + file in self.quarantined:
+            self.log('Skipping {}, which failed for another format'.format(to_unicode(file)))
+            file_record.quarantined = True
+            self.progress.emit(TASK_FAILED, returncode=None, quarantined=True,
+                               **fields)
+            return
+
+        def before_retry(returncode, stderr, timed_out):
+            if timed_out:
+                self.log('Transcoding {} timed out, retrying'.format(to_unicode(file)))
+            else:
+                self.log('Transcoding {} exited with code {}, retrying'.format(
+                    to_unicode(file), returncode))
+            self.progress.emit(TASK_RETRIED, returncode=returncode,
+                               timed_out=timed_out, **fields)
+            # Encoders won't overwrite what the failed attempt left behind.
+            if os.path.exists(transcoded):
+                os.remove(transcoded)
+
+        self.log('Transcoding {} ({} remaining)'.format(to_unicode(file), remaining))
+        if prefetcher is not None:
+            prefetcher.wait(src + '/' + file)
+        self.progress.emit(TASK_STARTED, **fields)
+        with self.tracer.span('encode', album=src, format=transcode_format,
+                              file=file):
+            returncode, stderr, timed_out, attempts = run_with_retries(
+                format_command(command, src + '/' + file, transcoded, *get_tags(src + '/' + file, info)),
+                task_timeout(fields['seconds'], fields['bytes'],
+                             self.timeout_factor, self.timeout_minimum),
+                self.retries, self.retry_backoff, before_retry=before_retry)
+        file_record.returncode = returncode
+        file_record.attempts = attempts
+        file_record.timed_out = timed_out
+
+        if returncode != 0:
+            if timed_out:
+                self.log('Error transcoding, process timed out {} times'.format(attempts))
+                self.fail(TIMEOUT_ERROR, record)
+            else:
+                self.log('Error transcoding, process exited with code {}'.format(returncode))
+            self.log('stderr output...')
+            self.log(stderr)
+            # Whatever the last attempt left behind is truncated at best.
+            if os.path.exists(transcoded):
+                os.remove(transcoded)
+            with self.exit_code_lock:
+                self.quarantined.add(src + '/' + file)
+            self.progress.emit(TASK_FAILED, returncode=returncode,
+                               timed_out=timed_out, **fields)
+        else:
+            self.progress.emit(TASK_FINISHED, **fields)
+
+    def probe(self, filename):
+        with self.tracer.span('probe', file=filename):
+            return self.probe_cache.probe(filename)
+
+    def task_fields(self, src, transcode_format, file, info):
+        return {
+            'album': src,
+            'format': transcode_format,
+            'file': file,
+            'bytes': os.path.getsize(src + '/' + file),
+            'seconds': get_duration(info),
+        }
+
+    def check_transcodes(self, filenames, record):
+        with self.tracer.span('validate', album=record.album.path,
+                              format=record.format):
+            valid = self.validate_transcodes(filenames, record)
+
+        # Only MP3 transcodes of FLAC tracks lose the art; the other encoders
+        # keep it.
+        for source, file in filenames:
+            if (not source.lower().endswith('.flac') or
+                    not file.lower().endswith('.mp3') or
+                    not record.file(source, file).valid):
+                continue
+            try:
+                with self.tracer.span('art', album=record.album.path,
+                                      format=record.format, file=file):
+                    copy_album_art(source, file)
+            except Exception as e:
+                self.log('Could not copy album art to {}'.format(file))
+                self.log(str(e))
+
+        return valid
+
+    def validate_transcodes(self, filenames, record):
+        valid = True
+        for source, file in filenames:
+            file_record = record.file(source, file)
+            file_record.valid = False
+            if file_record.returncode != 0:
+                self.log('An error occurred and {} was not transcoded'.format(file))
+                self.fail(TRANSCODE_ERROR, record)
+                valid = False
+            elif not os.path.isfile(file):
+                self.log('An error occurred and {} was not created'.format(file))
+                self.fail(TRANSCODE_ERROR, record)
+                valid = False
             elif os.path.getsize(file) == 0:
-                printb('An error occurred and {} is empty'.format(file))
-                self.exit_code |= TRANSCODE_ERROR
+                self.log('An error occurred and {} is empty'.format(file))
+                self.fail(TRANSCODE_ERROR, record)
+                valid = False
+            else:
+                file_record.valid = True
+        return valid
+
+    def queue_files(self, src, dst, files, extension, mktorrent,
+                    transcode_format):
+        batch = '%s-%d-%d-%d' % (socket.gethostname(), os.getpid(),
+                                 int(time.time()), len(self.queued))
+        filenames = []
+        tasks = []
+        fields = {}
+        for file in files:
+            transcoded = dst + '/' + file[:file.rfind('.') + 1] + extension
+            filenames.append((src + '/' + file, transcoded))
+            fields[src + '/' + file] = self.task_fields(
+                src, transcode_format, file,
+                self.probe(src + '/' + file) if self.progress.enabled else {})
+            tasks.append({
+                'source': src + '/' + file,
+                'destination': transcoded,
+                # Workers run their own command for the format; nothing
+                # from the shared directory is run as a shell command.
+                'format': transcode_format,
+                'timeout': task_timeout(fields[src + '/' + file]['seconds'],
+                                        fields[src + '/' + file]['bytes'],
+                                        self.timeout_factor,
+                                        self.timeout_minimum),
+            })
+            self.progress.emit(TASK_QUEUED, **fields[src + '/' + file])
+
+        self.queue.publish(batch, tasks)
+        self.log('Queued {} tracks for transcoding as {}'.format(len(tasks), batch))
+        self.queued.append({
+            'batch': batch,
+            'count': len(tasks),
+            'filenames': filenames,
+            'transcoded': dst,
+            'mktorrent': mktorrent,
+            'album': src,
+            'format': transcode_format,
+            'fields': fields,
+        })
 
+    def finish_queued(self, wait=True):
+        # Finalizes every album/format whose tasks have all been encoded by a
+        # worker, re-queueing tasks of dead workers along the way. With wait,
+        # blocks until nothing is left in flight.
+        while self.queued:
+            self.queue.requeue_expired()
+            for queued in self.queued[:]:
+                results = self.queue.results(queued['batch'])
+                if len(results) < queued['count']:
+                    continue
+                self.queued.remove(queued)
+                record = self.result.album(queued['album']).format(queued['format'])
+
+                for result in results:
+                    record.file(result['source'], result['destination']).returncode = result['returncode']
+                    fields = dict(queued['fields'][result['source']],
+                                  worker=result['worker'])
+                    if result['returncode'] != 0:
+                        self.log('Error transcoding {} on {}, process exited with code {}'.format(
+                            result['source'], result['worker'], result['returncode']))
+                        self.log('stderr output...')
+                        self.log(result['stderr'])
+                        self.progress.emit(TASK_FAILED,
+                                           returncode=result['returncode'],
+                                           **fields)
+                    else:
+                        self.progress.emit(TASK_FINISHED, **fields)
+                valid = self.check_transcodes(queued['filenames'], record)
+                self.progress.emit(FORMAT_FINISHED, album=queued['album'],
+                                   format=queued['format'],
+                                   destination=queued['transcoded'],
+                                   ok=valid)
+                self.finish_transcode(queued['transcoded'], queued['mktorrent'],
+                                      record=record)
+                self.queue.clear(queued['batch'])
+
+            if not wait:
+                return
+            if self.queued:
+                time.sleep(POLL_SECONDS)
+
+    def stage_transcode(self, source, transcoded, directories, files,
+                        lossless_files, transcode_format, mktorrent,
+                        unchanged=()):
+        staged = self.staging.staged_path(transcoded)
+        if os.path.exists(staged):
+            self.log('Removing leftover staging directory: ', staged)
+            shutil.rmtree(staged)
+
+        size = directory_size(source, files + lossless_files + list(unchanged))
+        self.staging.reserve(size)
+        # Until the album is handed to the publisher, any failure has to give
+        # its scratch space back, or later albums wait for it forever.
         try:
-            for pair in filenames:
-                copy_album_art(*pair)
-        except:
-            pass
+            with self.tracer.span('copy', album=source, format=transcode_format):
+                copy_contents(source, staged, directories, files, self.throttle)
+            self.link_unchanged(source, staged, unchanged, transcode_format)
+            valid = self.transcode_files(source,
+                                         staged,
+                                         lossless_files,
+                                         transcode_commands[transcode_format],
+                                         extensions[transcode_format],
+                                         transcode_format)
+        except Exception:
+            self.staging.discard(staged, size)
+            raise
+        finally:
+            # Results name where the files end up, not the scratch copies.
+            record = self.result.album(source).format(transcode_format)
+            for file_record in record.files.values():
+                if file_record.output.startswith(staged + '/'):
+                    file_record.output = transcoded + file_record.output[len(staged):]
+        if not valid:
+            self.log('Not publishing incomplete transcode ', transcoded)
+            self.staging.discard(staged, size)
+            return
+
+        # The staged directory has the same name as the published one, so the
+        # torrent is hashed from fast local storage before it moves. Unchanged
+        # tracks are only copies in scratch when it is another filesystem;
+        # they are linked from the source again when published.
+        links = dict((staged + '/' + file, source + '/' + file)
+                     for file in unchanged)
+        self.finish_transcode(
+            staged, mktorrent,
+            then=lambda: self.staging.publish(staged, transcoded, size, links),
+            record=self.result.album(source).format(transcode_format))
+
+    def finish_staged(self):
+        if self.staging is None:
+            return
+        failed = self.staging.wait()
+        for album in self.result.albums.values():
+            for record in album.formats.values():
+                if record.output in failed:
+                    self.fail(PUBLISH_ERROR, record)
+
+    def is_lossy_master(self, album_path, lossless_files, record=None):
+        # Analyses the tracks on the same encoder slots as transcodes, one
+        # bounded stream of PCM per slot.
+        remaining = lossless_files[:]
+        remaining_lock = threading.Lock()
+        results = []
+
+        def analyze_remaining():
+            while True:
+                with self.slots.slot(self.priority) as slot, self.tracer.on_slot(slot):
+                    with remaining_lock:
+                        if not remaining:
+                            return
+                        file = remaining.pop()
+                    try:
+                        duration = get_duration(
+                            self.probe(album_path + '/' + file))
+                        with self.tracer.span('spectral', album=album_path,
+                                              file=file):
+                            result = analyze_track(album_path + '/' + file,
+                                                   self.spectral_seconds, duration)
+                    except Exception as e:
+                        self.log('Could not analyse ' + file)
+                        self.log(str(e))
+                        continue
+                    with remaining_lock:
+                        results.append(result)
+
+        self.log('Checking the spectrum of %d tracks' % (len(remaining)))
+        threads = [threading.Thread(target=analyze_remaining)
+                   for _ in range(min(self.max_threads, len(remaining)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-    def is_transcode_allowed(self, has_lossy, lossless_files, explicit_transcode):
+        for result in sorted(results, key=lambda result: result['file']):
+            if record is not None and not result['error']:
+                record.cutoffs[result['file']] = result['cutoff']
+            if result['cutoff'] is not None:
+                self.log('%s has a cutoff at %d Hz' % (
+                    result['file'][len(album_path) + 1:], result['cutoff']))
+
+        lossy = looks_lossy(results)
+        if record is not None:
+            record.flagged = lossy
+        if lossy:
+            self.log('Album looks transcoded from a lossy source: ', album_path)
+        return lossy
+
+    def is_transcode_allowed(self, has_lossy, lossless_files, explicit_transcode, record=None):
         if has_lossy > 0:
             if len(lossless_files) == 0:
-                printb('Cannot transcode lossy formats, exiting')
-                self.exit_code |= TRANSCODE_AGAINST_RULES
+                self.log('Cannot transcode lossy formats, exiting')
+                self.fail(TRANSCODE_AGAINST_RULES, record)
                 return False
             elif not explicit_transcode:
-                printb('Found mixed lossy and lossless, you must explicitly enable transcoding')
-                self.exit_code |= TRANSCODE_AGAINST_RULES
+                self.log('Found mixed lossy and lossless, you must explicitly enable transcoding')
+                self.fail(TRANSCODE_AGAINST_RULES, record)
                 return False
 
         if len(lossless_files) == 0:
-            printb('Nothing to transcode!')
-            self.exit_code |= TRANSCODE_AGAINST_RULES
+            self.log('Nothing to transcode!')
+            self.fail(TRANSCODE_AGAINST_RULES, record)
             return False
 
         return True
 
-    def make_torrent(self, directory, output, announce_url):
-        printb('Making torrent for ' + directory)
+    def make_torrent(self, directory, output, announce_url, record=None):
+        self.log('Making torrent for ' + directory)
 
         if self.torrent_command is None:
-            self.torrent_command = find_torrent_command(torrent_commands)
+            self.torrent_command = self.toolchain.find_torrent_command(torrent_commands)
             if self.torrent_command is None:
-                printb('No torrent client found, can\'t create a torrent')
-                self.exit_code |= NO_TORRENT_CLIENT
+                self.log('No torrent client found, can\'t create a torrent')
+                self.fail(NO_TORRENT_CLIENT, record)
                 return None
 
         new_torrent_path = os.path.join(self.torrent_output, output)
         command = format_command(self.torrent_command, directory, new_torrent_path, announce_url)
-        torrent_status = subprocess.call(command, shell=True)
+
+        def before_retry(returncode, stderr, timed_out):
+            self.log('Making torrent file {}, retrying'.format(
+                'timed out' if timed_out else 'exited with status {}'.format(returncode)))
+            # Torrent clients refuse to overwrite an existing file.
+            if os.path.exists(new_torrent_path):
+                os.remove(new_torrent_path)
+
+        with self.tracer.span('torrent', album=directory):
+            torrent_status, stderr, timed_out, _ = run_with_retries(
+                command, self.torrent_timeout or None, self.retries,
+                self.retry_backoff, show_output=True, before_retry=before_retry)
         if torrent_status != 0:
-            printb('Making torrent file exited with status {}!'.format(torrent_status))
-            self.exit_code |= TORRENT_ERROR
+            if timed_out:
+                self.log('Making torrent file timed out!')
+                self.fail(TIMEOUT_ERROR, record)
+            else:
+                self.log('Making torrent file exited with status {}!'.format(torrent_status))
+            self.log(stderr)
+            self.fail(TORRENT_ERROR, record)
             return None
         return new_torrent_path
 
@@ -290,14 +880,12 @@ class Job(object):
     def process_album(self, album_path, do_transcode, explicit_transcode, transcode_formats, do_torrent, explicit_torrent,
                       original_torrent):
 
-        torrent_path = None
+        record = self.result.album(album_path)
+
         if original_torrent:
             _, directory_name = os.path.split(album_path)
             torrent_filename = '%s.torrent' % (directory_name)
-            torrent_path = self.make_torrent(album_path, torrent_filename, self.announce)
-
-        if torrent_path and self.source:
-            self.embed_source(torrent_path)
+            self.submit_torrent(album_path, torrent_filename, record=record)
 
         if not do_transcode:
             return
@@ -307,9 +895,17 @@ class Job(object):
          has_lossy,
          lossless_files) = enumerate_contents(album_path)
 
-        if not self.is_transcode_allowed(has_lossy, lossless_files, explicit_transcode):
+        if not self.is_transcode_allowed(has_lossy, lossless_files, explicit_transcode, record):
+            record.skipped = 'not allowed'
             return
 
+        if self.spectral_check and self.is_lossy_master(album_path, lossless_files, record):
+            if self.spectral_check == 'skip':
+                self.log('Skipping album that looks transcoded from a lossy source')
+                self.fail(LOSSY_MASTER, record)
+                record.skipped = 'lossy master'
+                return
+
         self.transcode_album(album_path,
                         directories,
                         data_files,
@@ -323,14 +919,17 @@ class Job(object):
         dir_has_codec = re.search(codec_regex, source, flags=re.IGNORECASE) is not None
 
         for transcode_format in formats:
+            record = self.result.album(source).format(transcode_format)
             command = transcode_commands[transcode_format]
-            if not command_exists(command):
-                printb('Cannot transcode to %s: "%s" not found' % (
+            # Queued tracks are encoded by workers, which may have encoders
+            # this host lacks.
+            if self.queue is None and not self.toolchain.command_exists(command):
+                self.log('Cannot transcode to %s: "%s" not found' % (
                     transcode_format, base_command(command)))
-                self.exit_code |= NO_TRANSCODER
+                self.fail(NO_TRANSCODER, record)
                 continue
 
-            printb('\nTranscoding to %s' % (transcode_format))
+            self.log('\nTranscoding to %s' % (transcode_format))
 
             if dir_has_codec:
                 transcoded = re.sub(
@@ -346,50 +945,156 @@ class Job(object):
                                          self.prefix,
                                          self.snip_prefixes)
             transcoded = self.transcode_output + '/' + transcoded
+            record.output = transcoded
+
+            # A lossless format whose spec the album already has would only
+            # duplicate it; on mixed albums only the other tracks are encoded.
+            unchanged = self.unchanged_tracks(source, lossless_files, transcode_format)
+            if unchanged and len(unchanged) == len(lossless_files):
+                self.log('Not transcoding to %s: every track already is %d-bit %d Hz FLAC' % (
+                    (transcode_format,) + unchanged_specs[transcode_format]))
+                record.skipped = 'already in format'
+                continue
+            to_encode = [file for file in lossless_files if file not in set(unchanged)]
 
             if os.path.exists(transcoded):
-                printb('Directory already exists: ', transcoded)
+                self.log('Directory already exists: ', transcoded)
                 if not explicit_transcode:
-                    self.exit_code |= TRANSCODE_DIR_EXISTS
+                    self.fail(TRANSCODE_DIR_EXISTS, record)
                     continue
             else:
-                copy_contents(source, transcoded, directories, files)
+                if self.staging is not None:
+                    self.stage_transcode(source,
+                                         transcoded,
+                                         directories,
+                                         files,
+                                         to_encode,
+                                         transcode_format,
+                                         mktorrent,
+                                         unchanged)
+                    continue
+                with self.tracer.span('copy', album=source, format=transcode_format):
+                    copy_contents(source, transcoded, directories, files, self.throttle)
+                self.link_unchanged(source, transcoded, unchanged, transcode_format)
+                if self.queue is not None:
+                    self.queue_files(source,
+                                     transcoded,
+                                     to_encode,
+                                     extensions[transcode_format],
+                                     mktorrent,
+                                     transcode_format)
+                    continue
                 self.transcode_files(source,
                                     transcoded,
-                                    lossless_files,
+                                    to_encode,
                                     transcode_commands[transcode_format],
-                                    extensions[transcode_format])
+                                    extensions[transcode_format],
+                                    transcode_format)
+
+            self.finish_transcode(transcoded, mktorrent, record=record)
 
-            torrent_path = None
-            if mktorrent:
-                _, filename = os.path.split(transcoded)
-                filename = filename + '.torrent'
-                torrent_path = self.make_torrent(transcoded, filename, self.announce)
+    def unchanged_tracks(self, source, lossless_files, transcode_format):
+        # The FLAC tracks that already have the bit depth and sample rate of a
+        # lossless format, which need no transcoding to it.
+        if transcode_format not in unchanged_specs or not self.toolchain.which('ffprobe'):
+            return []
+        unchanged = []
+        for file in lossless_files:
+            if not file.lower().endswith('.flac'):
+                continue
+            codec, bits, rate = get_audio_spec(self.probe(source + '/' + file))
+            if codec == 'flac' and (bits, rate) == unchanged_specs[transcode_format]:
+                unchanged.append(file)
+        return unchanged
+
+    def link_unchanged(self, source, transcoded, unchanged, transcode_format):
+        if not unchanged:
+            return
+        self.log('Linking {} tracks that are already {}'.format(len(unchanged), transcode_format))
+        record = self.result.album(source).format(transcode_format)
+        for file in unchanged:
+            with self.tracer.span('link', album=source, format=transcode_format,
+                                  file=file):
+                link_or_copy(source + '/' + file, transcoded + '/' + file)
+            file_record = record.file(source + '/' + file, transcoded + '/' + file)
+            file_record.returncode = 0
+            file_record.valid = True
+            file_record.unchanged = True
+
+    def finish_transcode(self, transcoded, mktorrent, then=None, record=None):
+        if mktorrent:
+            _, filename = os.path.split(transcoded)
+            filename = filename + '.torrent'
+            self.submit_torrent(transcoded, filename, then, record)
+        elif then is not None:
+            then()
+
+    def submit_torrent(self, directory, filename, then=None, record=None):
+        # Torrents are hashed on their own small pool so that transcoding
+        # moves on to the next format or album in the meantime. then runs
+        # once the torrent is done, whether or not it succeeded.
+        if self.torrents is None:
+            self.torrent_task(directory, filename, then, record)
+        else:
+            self.torrent_tasks.append(self.torrents.apply_async(
+                self.torrent_task, (directory, filename, then, record)))
+
+    def torrent_task(self, directory, filename, then, record):
+        # Exceptions raised on a pool thread would be silently dropped.
+        try:
+            torrent_path = self.make_torrent(directory, filename, self.announce, record)
             if torrent_path and self.source:
-                self.embed_source(torrent_path)
+                self.embed_source(torrent_path, record)
+            if torrent_path and record is not None:
+                record.torrent = torrent_path
+        except Exception as e:
+            self.log('Could not make a torrent of ' + directory)
+            self.log(str(e))
+            self.fail(TORRENT_ERROR, record)
+        if then is not None:
+            then()
+
+    def finish_torrents(self):
+        # A pool shared with other jobs is left running; only this job's
+        # torrents are waited for.
+        for task in self.torrent_tasks:
+            task.wait()
+        self.torrent_tasks = []
+        if self.torrents is not None and self.owns_torrents:
+            self.torrents.close()
+            self.torrents.join()
+            self.torrents = None
 
-    def embed_source(self, torrent_path):
-        printb('embedding source = "%s" into %s' % (self.source, torrent_path))
+    def embed_source(self, torrent_path, record=None):
+        self.log('embedding source = "%s" into %s' % (self.source, torrent_path))
         try:
-            torrent = Bencode(torrent_path)
-            torrent.read()
-            torrent['info']['source'] = self.source
-            torrent.write()
+            with self.tracer.span('source_embed', torrent=torrent_path):
+                torrent = Bencode(torrent_path)
+                torrent.read()
+                torrent['info']['source'] = self.source
+                torrent.write()
         except Exception as e:
-            printb('Could not embed source "%s" in %s' % (
+            self.log('Could not embed source "%s" in %s' % (
                 self.source, torrent_path))
-            print(e)
-            self.exit_code |= SOURCE_EMBED_ERROR
+            self.log(str(e))
+            self.fail(SOURCE_EMBED_ERROR, record)
 
 
-    def exit_if_error(self):
-        if self.exit_code != 0:
-            self.exit()
+    def fail(self, code, record=None):
+        # Torrents and publishing run on other threads, so the bitmask is
+        # updated under a lock. record is the redbetter.result album or format
+        # result the error belongs to, if any.
+        with self.exit_code_lock:
+            self.exit_code |= code
+            if record is not None:
+                record.add_error(code)
+            else:
+                self.result.add_error(code)
 
     def exit(self):
         if (self.exit_code != 0):
-            printb('An error occurred, exiting with code {0}'.format(self.exit_code))
-        sys.exit(self.exit_code)
+            self.log('An error occurred, exiting with code {0}'.format(self.exit_code))
+        sys.exit(exit_status(self.exit_code))
 
 
 # transcode_commands is the map of how to transcode into each format. The
@@ -432,6 +1137,13 @@ extensions = {
     'v2': 'mp3'
 }
 
+# unchanged_specs maps lossless formats to the bits per sample and sample rate
+# of FLAC tracks that are linked as they are instead of being transcoded.
+unchanged_specs = {
+    '16-48': (16, 48000),
+    '16-44': (16, 44100),
+}
+
 # codecs is use in string matching. If, in naming an album's folder name, you
 # would use [FLAC] or [ALAC] or [320], then the lowercase contents of the
 # brackets belongs in codecs so it can be matched and replaced with the
@@ -3,13 +3,19 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
+import collections
+import csv
+import io
 import json
+import multiprocessing
 import os
 import shlex
 import shutil
 import subprocess
+import sys
+import threading
 
-from redbetter.compat import mutagen
+from redbetter.compat import get_mutagen
 from redbetter.compat import quote
 from redbetter.compat import to_unicode
 from redbetter.compat import which
@@ -22,6 +28,10 @@ LOSSLESS_EXT = {'flac', 'wav', 'm4a'}
 # The list of lossy file extensions
 LOSSY_EXT = {'mp3', 'aac', 'opus', 'ogg', 'vorbis'}
 
+# Items are handed to each process of map_in_pool() in chunks of this many, so
+# that pickling them and their results doesn't dominate for small ones.
+CHUNK_SIZE = 64
+
 
 def format_command(command, *args):
     safe_args = [quote(arg) for arg in args]
@@ -43,7 +53,7 @@ def find_torrent_command(commands):
     return None
 
 
-def copy_contents(src, dst, dirs, files):
+def copy_contents(src, dst, dirs, files, throttle=None):
     # from distutils import dir_util
     # dir_util.copy_tree("./src", "./dst")
     os.mkdir(dst)
@@ -52,7 +62,12 @@ def copy_contents(src, dst, dirs, files):
         os.mkdir(dst + '/' + subdir)
 
     for file in files:
-        shutil.copy(src + '/' + file, dst + '/' + file)
+        if throttle is None:
+            shutil.copy(src + '/' + file, dst + '/' + file)
+        else:
+            # Copies count as readers of the source's device.
+            with throttle.reading(src + '/' + file):
+                shutil.copy(src + '/' + file, dst + '/' + file)
 
 
 def adjust_prefixes(name, to_add=None, to_remove=None):
@@ -67,9 +82,76 @@ def adjust_prefixes(name, to_add=None, to_remove=None):
     return name
 
 
-def get_tags(filename):
-    command = 'ffprobe -v 0 -print_format json -show_format'.split(' ') + [filename]
-    info = json.loads(to_unicode(subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0]))
+def link_or_copy(src, dst):
+    # Returns whether dst could be a hard link to src rather than a copy, which
+    # it has to be across filesystems.
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:
+        shutil.copy(src, dst)
+        return False
+
+
+def probe(filename):
+    command = 'ffprobe -v 0 -print_format json -show_format -show_streams'.split(' ') + [filename]
+    return json.loads(to_unicode(subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0]))
+
+
+class ProbeCache(object):
+    # Remembers ffprobe's output per file, keyed by path, size and mtime so
+    # an edited file is probed again, and forgets the least recently used
+    # files beyond max_entries. One instance can be shared by any number of
+    # jobs and threads.
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def probe(self, filename):
+        stat = os.stat(filename)
+        key = (filename, stat.st_size, stat.st_mtime)
+        with self.lock:
+            info = self.entries.pop(key, None)
+            if info is not None:
+                self.entries[key] = info
+                return info
+
+        info = probe(filename)
+        with self.lock:
+            self.entries[key] = info
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return info
+
+
+def get_duration(info):
+    # The length in seconds of the audio in a probed file, 0 if unknown.
+    try:
+        return float(info['format']['duration'])
+    except (KeyError, TypeError, ValueError):
+        return 0.0
+
+
+def get_audio_spec(info):
+    # The codec, bits per sample and sample rate of the first audio stream in
+    # a probed file, or (None, 0, 0) if unknown.
+    for stream in info.get('streams', []):
+        if stream.get('codec_type') != 'audio':
+            continue
+        try:
+            bits = int(stream.get('bits_per_raw_sample') or
+                       stream.get('bits_per_sample') or 0)
+            rate = int(stream.get('sample_rate') or 0)
+        except ValueError:
+            return None, 0, 0
+        return stream.get('codec_name'), bits, rate
+    return None, 0, 0
+
+
+def get_tags(filename, info=None):
+    if info is None:
+        info = probe(filename)
 
     if 'format' not in info or 'tags' not in info['format']:
         return '', '', '', '', ''
@@ -89,6 +171,7 @@ def get_tags(filename):
 
 
 def copy_album_art(source, dest):
+    mutagen = get_mutagen()
     if mutagen is None:
         return
 
@@ -132,3 +215,37 @@ def enumerate_contents(directory):
 
 def normalize_directory_path(path):
     return os.path.abspath(os.path.expanduser(path)).rstrip('/')
+
+
+def map_in_pool(function, items, processes=None):
+    # Returns [function(item) for item in items], computed by a pool of
+    # processes (one per CPU core unless processes is given) when there are
+    # enough items to be worth it. function runs in a worker process, so it
+    # has to return its errors rather than raise them.
+    if processes == 1 or len(items) < CHUNK_SIZE:
+        return [function(item) for item in items]
+
+    pool = multiprocessing.Pool(processes or None)
+    try:
+        return list(pool.imap(function, items, CHUNK_SIZE))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def write_rows(rows, fields, filename):
+    # Writes rows (dicts) to a .json file as they are, or to a .csv file with
+    # fields as its columns.
+    if filename.endswith('.json'):
+        with io.open(filename, 'w', encoding='utf-8') as output:
+            output.write(to_unicode(json.dumps(rows, indent=2)))
+        return
+
+    if sys.version_info[0] < 3:
+        output = open(filename, 'wb')
+    else:
+        output = io.open(filename, 'w', encoding='utf-8', newline='')
+    with output:
+        writer = csv.DictWriter(output, fields)
+        writer.writeheader()
+        writer.writerows(rows)
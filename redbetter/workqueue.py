@@ -0,0 +1,308 @@
+# coding: utf-8
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+import argparse
+import errno
+import json
+import os
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+import uuid
+
+from redbetter.compat import new_session
+from redbetter.compat import print_bytes as printb
+from redbetter.compat import to_unicode
+from redbetter.utils import format_command
+from redbetter.utils import get_tags
+
+
+# A work queue is a directory on a filesystem shared by every host (e.g. an
+# NFS export), mounted at the same path everywhere so that album paths inside
+# the tasks resolve on each worker. Each task is one JSON file that moves
+# between these subdirectories with os.rename, which is atomic on local
+# filesystems and NFS alike, so exactly one worker wins every claim:
+#   pending/  tasks waiting for a worker
+#   claimed/  tasks being encoded; the file's mtime is the worker's lease
+#   done/     results of tasks that exited with 0
+#   failed/   results of tasks that exited with anything else
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+TASK_DIRS = (PENDING, CLAIMED, DONE, FAILED)
+
+# A claimed task whose lease has not been renewed for this many seconds is
+# assumed to belong to a dead worker and is moved back to pending/.
+LEASE_SECONDS = 60
+
+# How often, in seconds, idle workers look for new tasks.
+POLL_SECONDS = 1.0
+
+# Only the end of stderr is kept in results, the same part printed on errors.
+STDERR_TAIL = 4096
+
+# The returncode recorded for a task the worker couldn't run at all.
+TASK_ERROR = 1
+
+
+class WorkQueue(object):
+    def __init__(self, path, lease=LEASE_SECONDS):
+        self.path = path
+        self.lease = lease
+
+    def setup(self):
+        for name in TASK_DIRS:
+            try:
+                os.mkdir(os.path.join(self.path, name))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return self
+
+    def _task_path(self, state, name):
+        return os.path.join(self.path, state, name)
+
+    def _write(self, path, data):
+        # Write next to the queue's subdirectories and rename into place so
+        # nobody ever sees a partially written task or result.
+        temporary = os.path.join(self.path, '.%s.%s.%d.tmp' % (
+            os.path.basename(path), socket.gethostname(), os.getpid()))
+        with open(temporary, 'w') as output:
+            json.dump(data, output)
+        os.rename(temporary, path)
+
+    def _read(self, path):
+        with open(path, 'r') as task:
+            return json.load(task)
+
+    def now(self):
+        # Hosts' clocks drift, so leases are measured against the shared
+        # filesystem's clock by touching a file and reading back its mtime.
+        clock = os.path.join(self.path, '.clock.%s' % (socket.gethostname()))
+        with open(clock, 'a'):
+            os.utime(clock, None)
+        return os.stat(clock).st_mtime
+
+    def publish(self, batch, tasks):
+        names = []
+        for i, task in enumerate(tasks):
+            name = '%s.%05d.json' % (batch, i)
+            task = dict(task, batch=batch, name=name)
+            self._write(self._task_path(PENDING, name), task)
+            names.append(name)
+        return names
+
+    def claim(self):
+        for name in sorted(os.listdir(os.path.join(self.path, PENDING))):
+            try:
+                os.rename(self._task_path(PENDING, name),
+                          self._task_path(CLAIMED, name))
+            except OSError:
+                # Another worker claimed it first.
+                continue
+            # The rename keeps the publish time; start the lease now.
+            if not self.renew(name):
+                continue
+            try:
+                task = self._read(self._task_path(CLAIMED, name))
+                # A token of this claim, so that a worker whose task was
+                # re-queued and claimed again can tell it isn't its own.
+                task['claim'] = uuid.uuid4().hex
+                self._write(self._task_path(CLAIMED, name), task)
+                return task
+            except (IOError, OSError, ValueError):
+                continue
+        return None
+
+    def renew(self, name, claim=None):
+        # Returns False once the lease was lost, i.e. the task was re-queued
+        # because this worker looked dead to somebody else, and, given the
+        # claim token, also once somebody else claimed it again.
+        path = self._task_path(CLAIMED, name)
+        try:
+            if claim is not None and self._read(path).get('claim') != claim:
+                return False
+            os.utime(path, None)
+            return True
+        except (IOError, OSError, ValueError):
+            return False
+
+    def complete(self, task, returncode, stderr=''):
+        state = DONE if returncode == 0 else FAILED
+        result = dict(task,
+                      returncode=returncode,
+                      stderr=to_unicode(stderr or '')[-STDERR_TAIL:],
+                      worker=socket.gethostname())
+        self._write(self._task_path(state, task['name']), result)
+        try:
+            os.remove(self._task_path(CLAIMED, task['name']))
+        except OSError:
+            pass
+
+    def requeue_expired(self):
+        requeued = []
+        now = self.now()
+        for name in os.listdir(os.path.join(self.path, CLAIMED)):
+            claimed = self._task_path(CLAIMED, name)
+            try:
+                if now - os.stat(claimed).st_mtime < self.lease:
+                    continue
+                os.rename(claimed, self._task_path(PENDING, name))
+            except OSError:
+                continue
+            requeued.append(name)
+        return requeued
+
+    def results(self, batch):
+        results = []
+        prefix = batch + '.'
+        for state in (DONE, FAILED):
+            for name in os.listdir(os.path.join(self.path, state)):
+                if name.startswith(prefix):
+                    results.append(self._read(self._task_path(state, name)))
+        return results
+
+    def clear(self, batch):
+        prefix = batch + '.'
+        for state in (DONE, FAILED):
+            for name in os.listdir(os.path.join(self.path, state)):
+                if name.startswith(prefix):
+                    os.remove(self._task_path(state, name))
+
+    def is_empty(self):
+        return not (os.listdir(os.path.join(self.path, PENDING)) or
+                    os.listdir(os.path.join(self.path, CLAIMED)))
+
+
+class Worker(object):
+    def __init__(self, queue, poll=POLL_SECONDS, exit_when_empty=False):
+        self.queue = queue
+        self.poll = poll
+        self.exit_when_empty = exit_when_empty
+
+    def run(self):
+        while True:
+            self.queue.requeue_expired()
+            task = self.queue.claim()
+            if task is None:
+                if self.exit_when_empty and self.queue.is_empty():
+                    return
+                time.sleep(self.poll)
+                continue
+            try:
+                self.run_task(task)
+            except Exception as e:
+                # E.g. no ffprobe for the tags or an unwritable destination:
+                # the task fails, the worker goes on with the next one.
+                self.fail_task(task, e)
+
+    def fail_task(self, task, error):
+        printb('Error transcoding {}: {}'.format(task['source'], error))
+        if not self.keeps_lease(task):
+            return
+        try:
+            if os.path.exists(task['destination']):
+                os.remove(task['destination'])
+            self.queue.complete(task, TASK_ERROR, '{}: {}'.format(
+                type(error).__name__, to_unicode(str(error))))
+        except (IOError, OSError) as e:
+            # Once its lease expires the task is claimed again.
+            printb('Could not record the failure of {}: {}'.format(
+                task['source'], e))
+
+    def keeps_lease(self, task):
+        # Checked right before completing a task: after losing the lease the
+        # destination and the claimed file belong to another worker, and
+        # this run's result must not be recorded.
+        if self.queue.renew(task['name'], task.get('claim')):
+            return True
+        printb('Lost the lease on {}, dropping its result'.format(
+            task['source']))
+        return False
+
+    def run_task(self, task):
+        # transcode imports this module, so it is only imported once needed.
+        from redbetter.transcode import transcode_commands
+
+        src = task['source']
+        dst = task['destination']
+        if task.get('format') not in transcode_commands:
+            raise ValueError('Unknown format: {}'.format(task.get('format')))
+        printb('Transcoding {}'.format(src))
+
+        destination_dir = os.path.dirname(dst)
+        if not os.path.isdir(destination_dir):
+            os.makedirs(destination_dir)
+
+        # stderr goes to a file rather than a pipe: nothing reads a pipe while
+        # the lease is renewed, and a chatty encoder would fill it and hang.
+        with open(os.devnull, 'wb') as devnull, tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(
+                format_command(transcode_commands[task['format']], src, dst,
+                               *get_tags(src)),
+                stdin=None, stdout=devnull, stderr=stderr, shell=True,
+                # A new session lets a lost lease kill the whole pipeline.
+                **new_session
+            )
+
+            started = renewed = time.time()
+            timed_out = False
+            while process.poll() is None:
+                # Tasks carry a deadline scaled to the track's length; a hung
+                # encoder must not renew its lease forever.
+                if task.get('timeout') and time.time() - started >= task['timeout']:
+                    printb('Transcoding {} timed out'.format(src))
+                    os.killpg(process.pid, signal.SIGKILL)
+                    process.wait()
+                    timed_out = True
+                    break
+                if time.time() - renewed >= self.queue.lease / 3:
+                    renewed = time.time()
+                    if not self.queue.renew(task['name'], task.get('claim')):
+                        printb('Lost the lease on {}, abandoning it'.format(src))
+                        os.killpg(process.pid, signal.SIGKILL)
+                        process.wait()
+                        return
+                time.sleep(0.05)
+
+            stderr.seek(0)
+            output = to_unicode(stderr.read())
+            if timed_out:
+                output += '\nTimed out after {} seconds'.format(task['timeout'])
+
+        if not self.keeps_lease(task):
+            return
+        if process.returncode != 0:
+            printb('Error transcoding, process exited with code {}'.format(process.returncode))
+            if os.path.exists(dst):
+                os.remove(dst)
+        self.queue.complete(task, process.returncode, output)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Encode tasks published by "redbetter --queue" into a '
+        'work queue directory shared between hosts.')
+    parser.add_argument('queue', help='The shared work queue directory')
+    parser.add_argument(
+            '-e',
+            '--exit-when-empty',
+            action='store_true',
+            help='Exit once no tasks are pending or claimed instead of '
+            'waiting for more')
+    parser.add_argument(
+            '-l',
+            '--lease',
+            action='store',
+            type=int, default=LEASE_SECONDS,
+            help='Seconds without a heartbeat before a claimed task is '
+            're-queued (default: %(default)s)')
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue, lease=args.lease).setup()
+    Worker(queue, exit_when_empty=args.exit_when_empty).run()
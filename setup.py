@@ -9,5 +9,6 @@ setup(name='redbetter',
       author_email='fake@fake.com',
       url='https://www.fake.website',
       packages=['redbetter'],
-      scripts=['bin/redbetter'],
+      scripts=['bin/redbetter', 'bin/redbetter-worker',
+               'bin/redbetter-retorrent', 'bin/redbetter-crossseed'],
      )